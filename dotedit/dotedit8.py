@@ -4,32 +4,988 @@
 import sys                          # 終了用
 import os                           # ファイル保存、読み込み用
 import configparser                 # 設定ファイル用
+import argparse                     # コマンドライン引数用
+from array import array             # 元に戻す用の差分記録
+from collections import deque
+import glob                         # 一括変換用
+import hashlib                      # サムネイルのキャッシュファイル名用
+import json                         # プロジェクトファイルのメタデータ用
+import mmap                         # プロジェクトファイルの読み込み用
+import struct                       # 自動保存の記録ファイル用
+import tempfile                     # サムネイルのキャッシュの一時ファイル用
+import time                         # 自動保存の記録ファイル名用
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache     # 減色用の変換表のキャッシュ
 import pygame
 from pygame.locals import *
+if os.name == "nt":                 # 自動保存の記録ファイルのロック用
+    import msvcrt
+else:
+    import fcntl
 
-WINDOW_RECT = Rect(0, 0, 987, 631)                  # ウィンドウのサイズ
+WINDOW_RECT = Rect(0, 0, 987, 686)                  # ウィンドウのサイズ
 FPS = 20                                            # ゲームのFPS
+IDLE_TIMEOUT = 1000                                 # 何も変化が無いときにイベントを待つ最長時間（ミリ秒）
 
 # ユーザーイベント
 USEREVENT_MENU = pygame.USEREVENT                   # メニューボタン
 USEREVENT_PALETTSETTING = pygame.USEREVENT + 1      # パレット設定画面用
 USEREVENT_ALLUPDATE = pygame.USEREVENT + 2          # 全更新
+USEREVENT_MSGBOX = pygame.USEREVENT + 3             # メッセージボックスが閉じた
+USEREVENT_FILE = pygame.USEREVENT + 4               # 保存、読み込みの状況
+USEREVENT_AUTOSAVE = pygame.USEREVENT + 5           # 自動保存のタイマー
+USEREVENT_THUMBNAIL = pygame.USEREVENT + 6          # 読み込みブラウザのサムネイルができた
 
 # 線とか背景とかの色
 COLOR_BLACK = (0, 0, 0)
 COLOR_GRAY = (128, 128, 128)
 COLOR_SILVER = (192, 192, 192)
 COLOR_WHITE = (255, 255, 255)
+COLOR_TRANSPARENT = (255, 0, 254)   # レイヤーの抜き色（パレットの番号で持つときは255番）
+
+# 組織的ディザ（4x4）で色に足す値
+DITHER_ORDERED = (-30, 2, -22, 10,
+                  18, -14, 26, -6,
+                  -18, 14, -26, 6,
+                  30, -2, 22, -10)
+
+EDIT_TOOLS = ("pen", "fill", "replace", "line", "rect", "fillrect", "ellipse")
+                                # エディタ部のツール
+SHAPE_TOOLS = ("line", "rect", "fillrect", "ellipse")
+                                # ドラッグして図形を描くツール
+
+AUTOSAVE_INTERVAL = 30000       # 自動保存の間隔（ミリ秒）
+AUTOSAVE_COMPACT = 2            # 追加した記録がシートの何倍になったら全体を書き直すか
+AUTOSAVE_HEADER = struct.Struct("<4s7I")    # 記録ファイルのヘッダー
+                                            #   (b"DOTJ", 幅, 高さ, 1ドットのバイト数,
+                                            #    editcelx, editcely, blockx, blocky)
+AUTOSAVE_RECORD = struct.Struct("<3I")      # 記録ファイルのレコード
+                                            #   (シートの番号, ブロックの番号, サイズ)
+AUTOSAVE_META = 0xFFFFFFFF      # ドキュメントの情報(json)のレコードのシートの番号
+
+PROJECT_EXT = ".dotp"           # プロジェクトファイルの拡張子
+PROJECT_VERSION = 1
+PROJECT_HEADER = struct.Struct("<4s8I")     # プロジェクトファイルのヘッダー
+                                            #   (b"DOTP", バージョン, editcelx, editcely,
+                                            #    blockx, blocky, 1ドットのバイト数,
+                                            #    パレットの色数, シート数)
+PROJECT_SHEET = struct.Struct("<2I")        # シートの索引（名前のバイト数, メタデータのバイト数）
+PROJECT_CHUNK = struct.Struct("<QI")        # ブロックの索引（チャンクの位置, サイズ）
+
+THUMBNAIL_SIZE = 96             # 読み込みブラウザのサムネイルのサイズ
+THUMBNAIL_WORKERS = 4           # サムネイルを作るスレッドの数
+THUMBNAIL_MEMORY = 256          # メモリに残しておくサムネイルの数
+THUMBNAIL_TEMP_AGE = 3600       # これより古い（秒）書きかけのキャッシュは捨てる
 
 # メッセージボックスのタイプ
 MSGBOX_TYPE_OK = 1
 MSGBOX_TYPE_YESNO = 2
 MSGBOX_TYPE_INPUT = 3
 
+class UndoJournal:
+    """ 元に戻す／やり直しの記録\n
+    1ストローク（ボタンを押してから離すまで）に変わったドットを
+    (index, old, new) の差分で集め、連続するドットを連長圧縮して
+    [開始index, 長さ, 変更前の色, 変更後の色] の並びとして記録する\n
+    記録の合計がmaxsizeバイトを超えたら古いストロークから捨てる """
+    def __init__(self, maxsize, bpp=3):
+        self.maxsize = maxsize          # 記録に使うメモリの上限（バイト）
+        self.bpp = bpp                  # 1ドットのバイト数
+        self.size = 0                   # 記録に使っているメモリ（バイト）
+        self.undo_strokes = deque()     # 元に戻す用のストローク（右が新しい）
+        self.redo_strokes = []          # やり直し用のストローク
+        self.stroke = None              # 記録中のストローク
+                                        #   書き換えた順に並べるので、元に戻すときは
+                                        #   後ろから、やり直すときは前から書き戻す
+
+    def recording(self):
+        """ ストロークを記録中か？ """
+        return self.stroke is not None
+
+    def begin(self):
+        """ ストロークの記録開始 """
+        if self.stroke is None:
+            self.stroke = array("I")
+
+    def record(self, start, old, new):
+        """ 書き換えの記録\n
+        startから並ぶドットの変更前、変更後のバイト列を渡す\n
+        maxsizeが0のとき（一括変換など）はすぐ捨てるので記録しない """
+        if old == new or not self.maxsize:
+            return
+        bpp = self.bpp
+        length = len(old) // bpp
+        if old == old[:bpp] * length and new == new[:bpp] * length:
+            # 全部同じ色なら1つにまとめる
+            self.add_run(start, length, int.from_bytes(old[:bpp], "big"),
+                         int.from_bytes(new[:bpp], "big"))
+        elif length > 16:
+            # 半分に分けて同じ色の範囲を探す
+            half = length // 2 * bpp
+            self.record(start, old[:half], new[:half])
+            self.record(start + length // 2, old[half:], new[half:])
+        else:
+            for i in range(0, len(old), bpp):
+                if old[i:i + bpp] != new[i:i + bpp]:
+                    self.add_run(start + i // bpp, 1, int.from_bytes(old[i:i + bpp], "big"),
+                                 int.from_bytes(new[i:i + bpp], "big"))
+
+    def add_run(self, start, length, old, new):
+        """ 記録中のストロークに追加 直前と続いていればつなげる """
+        stroke = self.stroke
+        if stroke and stroke[-4] + stroke[-3] == start\
+            and stroke[-2] == old and stroke[-1] == new:
+            stroke[-3] += length
+        else:
+            stroke.extend((start, length, old, new))
+
+    def end(self):
+        """ ストロークの記録終了 """
+        stroke = self.stroke
+        self.stroke = None
+        if not stroke:
+            return
+
+        # 新しく記録したらやり直しはできない
+        for redo in self.redo_strokes:
+            self.size -= redo.itemsize * len(redo)
+        self.redo_strokes.clear()
+        self.undo_strokes.append(stroke)
+        self.size += stroke.itemsize * len(stroke)
+        # 上限を超えたら古いものから捨てる
+        while self.size > self.maxsize and self.undo_strokes:
+            old_stroke = self.undo_strokes.popleft()
+            self.size -= old_stroke.itemsize * len(old_stroke)
+
+    def undo(self):
+        """ 元に戻すストロークを取り出す 無いときはNone """
+        if not self.undo_strokes:
+            return None
+        stroke = self.undo_strokes.pop()
+        self.redo_strokes.append(stroke)
+        return stroke
+
+    def redo(self):
+        """ やり直すストロークを取り出す 無いときはNone """
+        if not self.redo_strokes:
+            return None
+        stroke = self.redo_strokes.pop()
+        self.undo_strokes.append(stroke)
+        return stroke
+
+    def clear(self):
+        """ 記録を全部消す """
+        self.undo_strokes.clear()
+        self.redo_strokes.clear()
+        self.size = 0
+        self.stroke = None
+
+class Layer:
+    """ シートのレイヤー\n
+    シートと同じ形式のドット情報を持ち、抜き色のドットは下のレイヤーが見える """
+    def __init__(self, uid, name, pixels, size, indexed):
+        self.uid = uid                  # 元に戻すの記録で使う番号（並べ替えても変わらない）
+        self.name = name                # レイヤー名
+        self.pixels = pixels            # ドット情報のバッファ（シートと同じ並び）
+        self.surface = pygame.image.frombuffer(pixels, size, "P" if indexed else "RGB")
+                                        # pixelsを共有するSurface（抜き色を設定して重ねる）
+        self.surface.set_colorkey(255 if indexed else COLOR_TRANSPARENT)
+        self.visible = True             # 表示するか？
+        self.opacity = 255              # 不透明度 0〜255
+                                        #   パレットの番号で持つときは128以上で表示、未満で非表示
+
+class SpriteSheet:
+    """ ドット絵のシート（ドキュメント）\n
+    全ブロックのドット情報を1枚のバッファで持ち、各画面はコピーせずに直接参照する\n
+    ブロックの番号は縦方向に数える（0:左上、1:その下・・・）\n
+    indexedがTrueのときは1ドットにパレットの番号(1バイト)を持ち、
+    パレットの色を変えるとシート全体の色が変わる\n
+    描き込みは選択中のレイヤーに行い、pixelsには全レイヤーを重ねた結果を持つ
+    （変更された範囲だけ重ね直す） """
+    def __init__(self, editcelx, editcely, blockx, blocky, undomemory=8 * 1024 * 1024,
+                 palett=None, indexed=False, quantize="off"):
+        self.editcelx = editcelx        # 1ブロックのサイズ
+        self.editcely = editcely
+        self.blockx = blockx            # ブロックの数
+        self.blocky = blocky
+        self.width = editcelx * blockx  # シート全体のサイズ
+        self.height = editcely * blocky
+        self.indexed = indexed          # パレットの番号で持つか？
+        self.bpp = 1 if indexed else 3  # 1ドットのバイト数
+        self.colors = []                # パレットの色(r, g, b)のリスト
+        self.nearest = {}               # 色から一番近いパレットの番号への変換表
+        self.quantize = quantize        # 読み込むときの減色方法
+                                        #   off（減色しない）, nearest, ordered, floyd
+        if palett is not None:
+            self.colors = [col[1] for col in palett]
+        self.transparent = bytes((255,)) if indexed else bytes(COLOR_TRANSPARENT)
+                                        # 抜き色のバイト列
+        self.pixels = bytearray(self.encode(COLOR_WHITE)) * (self.width * self.height)
+                                        # 全レイヤーを重ねたドット情報のバッファ
+                                        # 1ドット3バイト(R, G, B)か1バイト(パレットの番号)を
+                                        # 行優先で並べる
+        self.surface = pygame.image.frombuffer(self.pixels, (self.width, self.height),
+                                               "P" if indexed else "RGB")
+                                        # pixelsを共有するSurface
+                                        #   pixelsは作り直さずに中身だけ書き換えること
+        if indexed:
+            self.surface.set_palette(self.colors)
+        self.layers = []                # レイヤーのリスト（下から順に）
+        self.layer_uids = {}            # uidからレイヤーを引く辞書
+        self.active = None              # 描き込むレイヤー
+        self.layer_serial = 0           # レイヤーの構成や選択を変えるたびに増やす番号
+                                        #   （レイヤー画面が描き直すかの判定に使う）
+        self.listeners = []             # 変更通知先のリスト
+        self.reset_layers()
+        self.journal = UndoJournal(undomemory, self.bpp)    # 元に戻す／やり直しの記録
+                                        #   ドットの位置は uid * 全ドット数 + 位置 で記録する
+
+    def encode(self, col):
+        """ 色をpixelsに書き込むバイト列に変換\n
+        colは(r, g, b)かパレットの番号、Noneのときは抜き色 """
+        if col is None:
+            return self.transparent
+        if self.indexed:
+            if isinstance(col, int):
+                return bytes((col,))
+            return bytes((self.nearest_index(col),))
+        if isinstance(col, int):
+            col = self.colors[col]
+        if (col[0], col[1], col[2]) == COLOR_TRANSPARENT:
+            # 抜き色と同じ色は少しずらして描けるようにする
+            return bytes((col[0], col[1], col[2] ^ 1))
+        return bytes((col[0], col[1], col[2]))
+
+    def nearest_index(self, col):
+        """ colに一番近いパレットの番号を返す """
+        key = (col[0], col[1], col[2])
+        if key not in self.nearest:
+            self.nearest[key] = self.colors.index(nearest_color(key, self.colors))
+        return self.nearest[key]
+
+    def set_palett(self, palett):
+        """ パレットの色を設定する palettは(番号, (r, g, b))のリスト\n
+        パレットの番号で持っているときは、ドットはそのままで色だけが変わる """
+        self.colors = [col[1] for col in palett]
+        self.nearest.clear()
+        if self.indexed:
+            self.surface.set_palette(self.colors)
+            for layer in self.layers:
+                layer.surface.set_palette(self.colors)
+            self.notify(Rect(0, 0, self.width, self.height))
+
+    def reset_layers(self):
+        """ 白く塗った1枚だけのレイヤーに戻す """
+        self.layers.clear()
+        self.layer_uids.clear()
+        self.active = None
+        self.add_layer(COLOR_WHITE)
+        self.layer_serial += 1
+
+    def add_layer(self, col=None):
+        """ 選択中のレイヤーの上にcolで塗ったレイヤーを追加して選択する\n
+        colを省略すると透明なレイヤーになる """
+        uid = len(self.layer_uids)
+        layer = Layer(uid, f"L{uid}",
+                      bytearray(self.encode(col)) * (self.width * self.height),
+                      (self.width, self.height), self.indexed)
+        if self.indexed:
+            layer.surface.set_palette(self.colors)
+        self.layer_uids[uid] = layer
+        self.layers.insert(self.layers.index(self.active) + 1 if self.active else 0, layer)
+        self.active = layer
+        self.layer_serial += 1
+        if col is not None:
+            self.notify(Rect(0, 0, self.width, self.height))
+        return layer
+
+    def select_layer(self, layer):
+        """ 描き込むレイヤーを選択する """
+        self.active = layer
+        self.layer_serial += 1
+
+    def move_layer(self, layer, offset):
+        """ レイヤーの重なり順をoffsetだけ上(+)、下(-)に動かす """
+        index = self.layers.index(layer)
+        newindex = min(max(index + offset, 0), len(self.layers) - 1)
+        if newindex != index:
+            self.layers.insert(newindex, self.layers.pop(index))
+            self.layer_serial += 1
+            self.notify(Rect(0, 0, self.width, self.height))
+
+    def set_layer_visible(self, layer, visible):
+        """ レイヤーの表示、非表示を切り替える """
+        layer.visible = visible
+        self.layer_serial += 1
+        self.notify(Rect(0, 0, self.width, self.height))
+
+    def set_layer_opacity(self, layer, opacity):
+        """ レイヤーの不透明度(0〜255)を設定する """
+        layer.opacity = min(max(opacity, 0), 255)
+        self.layer_serial += 1
+        if not self.indexed:
+            layer.surface.set_alpha(layer.opacity if layer.opacity < 255 else None)
+        self.notify(Rect(0, 0, self.width, self.height))
+
+    def compose(self, rect):
+        """ rectの範囲だけ全レイヤーを重ね直してpixelsに書き込む\n
+        一番下は白（パレットの番号で持つときは白に一番近い色）にする """
+        if self.indexed:
+            self.surface.fill(self.encode(COLOR_WHITE)[0], rect)
+        else:
+            self.surface.fill(COLOR_WHITE, rect)
+        for layer in self.layers:
+            if not layer.visible or self.indexed and layer.opacity < 128:
+                continue
+            self.surface.blit(layer.surface, rect, rect)
+
+    def add_listener(self, listener):
+        """ 変更通知先を追加\n
+        listenerは変更されたシート上のRectを引数に呼び出される """
+        self.listeners.append(listener)
+
+    def notify(self, rect):
+        """ 変更を通知する 先に変更された範囲のレイヤーを重ね直す """
+        self.compose(rect)
+        for listener in self.listeners:
+            listener(rect)
+
+    def get_block_rect(self, index):
+        """ ブロックのシート上のRectを取得 """
+        return Rect(index // self.blocky * self.editcelx, index % self.blocky * self.editcely,
+                    self.editcelx, self.editcely)
+
+    def get_blocks_in_rect(self, rect):
+        """ rectに掛かるブロックの番号のリスト """
+        return [blockx * self.blocky + blocky
+                for blockx in range(rect.left // self.editcelx,
+                                    (rect.right - 1) // self.editcelx + 1)
+                for blocky in range(rect.top // self.editcely,
+                                    (rect.bottom - 1) // self.editcely + 1)]
+
+    def get_pixel(self, posx, posy):
+        """ ドットの色を(r, g, b)で取得 """
+        index = (posy * self.width + posx) * self.bpp
+        if self.indexed:
+            return tuple(self.colors[self.pixels[index]])
+        return tuple(self.pixels[index:index + 3])
+
+    def begin_stroke(self):
+        """ ストロークの開始\n
+        end_stroke()までの書き換えを1回の元に戻す単位にする """
+        self.journal.begin()
+
+    def end_stroke(self):
+        """ ストロークの終了 """
+        self.journal.end()
+
+    def write(self, index, data):
+        """ 選択中のレイヤーのindex（ドット単位）からdataを書き込み、元に戻す用に記録する """
+        start = index * self.bpp
+        pixels = self.active.pixels
+        self.journal.record(self.active.uid * self.width * self.height + index,
+                            pixels[start:start + len(data)], data)
+        pixels[start:start + len(data)] = data
+
+    def set_pixels(self, points, col):
+        """ 複数のドットの色をまとめて設定し、変更範囲を通知する\n
+        colは(r, g, b)かパレットの番号\n
+        ストローク外の書き換えはそれだけで1ストロークになる """
+        if not points:
+            return
+        colbytes = self.encode(col)
+        instroke = self.journal.recording()
+        self.journal.begin()
+        for posx, posy in points:
+            self.write(posy * self.width + posx, colbytes)
+        if not instroke:
+            self.journal.end()
+        xs = [point[0] for point in points]
+        ys = [point[1] for point in points]
+        self.notify(Rect(min(xs), min(ys), max(xs) - min(xs) + 1, max(ys) - min(ys) + 1))
+
+    def fill(self, col, rect=None):
+        """ 範囲を塗りつぶす rectを省略するとシート全体 """
+        if rect is None:
+            rect = Rect(0, 0, self.width, self.height)
+        row = self.encode(col) * rect.width
+        instroke = self.journal.recording()
+        self.journal.begin()
+        for posy in range(rect.top, rect.bottom):
+            self.write(posy * self.width + rect.left, row)
+        if not instroke:
+            self.journal.end()
+        self.notify(Rect(rect))
+
+    def clear(self, rect=None):
+        """ 範囲を消す rectを省略するとシート全体\n
+        一番下のレイヤーは白、それ以外のレイヤーは透明にする """
+        self.fill(COLOR_WHITE if self.active is self.layers[0] else None, rect)
+
+    def match_mask(self, rect, target, pixels=None):
+        """ rectの範囲で色がtarget（pixelsのバイト列）のドットを1、
+        それ以外を0にしたマスクを返す（rect内で行優先）\n
+        pixelsを省略すると選択中のレイヤーを調べる """
+        if pixels is None:
+            pixels = self.active.pixels
+        bpp = self.bpp
+        # 色の値ごとに一致するかどうかの変換表
+        tables = [bytes(1 if value == target[channel] else 0 for value in range(256))
+                  for channel in range(bpp)]
+        mask = bytearray()
+        for posy in range(rect.top, rect.bottom):
+            start = (posy * self.width + rect.left) * bpp
+            row = pixels[start:start + rect.width * bpp]
+            if bpp == 1:
+                mask += row.translate(tables[0])
+            else:
+                # R, G, Bそれぞれの一致をまとめてANDする
+                bits = int.from_bytes(row[0::3].translate(tables[0]), "big")\
+                    & int.from_bytes(row[1::3].translate(tables[1]), "big")\
+                    & int.from_bytes(row[2::3].translate(tables[2]), "big")
+                mask += bits.to_bytes(rect.width, "big")
+        return mask
+
+    def flood_fill(self, posx, posy, col, rect=None, connect8=False):
+        """ (posx, posy)とつながっている同じ色の範囲をcolで塗りつぶす\n
+        rectの範囲内だけ塗る（省略するとシート全体）\n
+        connect8がTrueのときは斜めもつながっているとみなす\n
+        1行ずつ横に広げるスキャンライン方式なので再帰はしない """
+        if rect is None:
+            rect = Rect(0, 0, self.width, self.height)
+        if not rect.collidepoint(posx, posy):
+            return
+        index = (posy * self.width + posx) * self.bpp
+        target = bytes(self.active.pixels[index:index + self.bpp])
+        colbytes = self.encode(col)
+        if target == colbytes:
+            return
+
+        # 塗れるドットを1にしたマスクの上で範囲を探す（塗ったら0にする）
+        mask = self.match_mask(rect, target)
+        width = rect.width
+        spans = []                      # 塗る範囲 (y, 左端, 右端+1)
+        stack = [(posx - rect.left, posy - rect.top)]
+        while stack:
+            maskx, masky = stack.pop()
+            row = masky * width
+            if not mask[row + maskx]:
+                continue
+            # 左右に広げる
+            left = mask.rfind(0, row, row + maskx) + 1
+            if left == 0:
+                left = row
+            right = mask.find(0, row + maskx, row + width)
+            if right < 0:
+                right = row + width
+            mask[left:right] = bytes(right - left)
+            spans.append((masky, left - row, right - row))
+            # 上下の行で塗れる範囲の先頭を積む
+            low = max(0, left - row - 1) if connect8 else left - row
+            high = min(width, right - row + 1) if connect8 else right - row
+            for nexty in (masky - 1, masky + 1):
+                if 0 <= nexty < rect.height:
+                    start = nexty * width + low
+                    end = nexty * width + high
+                    while start < end:
+                        start = mask.find(1, start, end)
+                        if start < 0:
+                            break
+                        stack.append((start - nexty * width, nexty))
+                        start = mask.find(0, start, end)
+                        if start < 0:
+                            break
+
+        instroke = self.journal.recording()
+        self.journal.begin()
+        for masky, left, right in spans:
+            self.write((rect.top + masky) * self.width + rect.left + left,
+                       colbytes * (right - left))
+        if not instroke:
+            self.journal.end()
+        self.notify(Rect(rect.left + min(span[1] for span in spans),
+                         rect.top + min(span[0] for span in spans),
+                         max(span[2] for span in spans) - min(span[1] for span in spans),
+                         max(span[0] for span in spans) - min(span[0] for span in spans) + 1))
+
+    def replace_color(self, posx, posy, col):
+        """ 選択中のレイヤー全体で(posx, posy)と同じ色のドットを全部colにする """
+        index = (posy * self.width + posx) * self.bpp
+        target = bytes(self.active.pixels[index:index + self.bpp])
+        colbytes = self.encode(col)
+        if target == colbytes:
+            return
+        # シート全体のマスクで同じ色が続く範囲ごとに書き込む
+        runs = mask_runs(self.match_mask(Rect(0, 0, self.width, self.height), target))
+        top = runs[0][0] // self.width
+        bottom = (runs[-1][1] - 1) // self.width + 1
+        instroke = self.journal.recording()
+        self.journal.begin()
+        for start, end in runs:
+            self.write(start, colbytes * (end - start))
+        if not instroke:
+            self.journal.end()
+        self.notify(Rect(0, top, self.width, bottom - top))
+
+    def undo(self):
+        """ 1ストローク元に戻す """
+        stroke = self.journal.undo()
+        if stroke is not None:
+            self.apply_stroke(stroke, range(len(stroke) - 4, -1, -4), 2)
+
+    def redo(self):
+        """ 1ストロークやり直す """
+        stroke = self.journal.redo()
+        if stroke is not None:
+            self.apply_stroke(stroke, range(0, len(stroke), 4), 3)
+
+    def apply_stroke(self, stroke, order, colindex):
+        """ 記録したストロークの色をorderの順に書き戻す\n
+        colindexは2で変更前、3で変更後の色 """
+        top = self.height
+        bottom = 0
+        for i in order:
+            uid, index = divmod(stroke[i], self.width * self.height)
+            start = index * self.bpp
+            length = stroke[i + 1]
+            self.layer_uids[uid].pixels[start:start + length * self.bpp] = \
+                stroke[i + colindex].to_bytes(self.bpp, "big") * length
+            top = min(top, index // self.width)
+            bottom = max(bottom, (index + length - 1) // self.width + 1)
+        self.notify(Rect(0, top, self.width, bottom - top))
+
+    def apply_palett(self, palett, dither="nearest"):
+        """ 選択中のレイヤーの全ドットをパレットの一番近い色に置き換える\n
+        palettは(番号, (r, g, b))のリスト ditherはquantize()を参照\n
+        パレットの番号で持っているときはパレットを入れ替えるだけ """
+        if self.indexed:
+            self.set_palett(palett)
+            return
+        colors = [col[1] for col in palett]
+        fullrect = Rect(0, 0, self.width, self.height)
+        data = indices_to_rgb(quantize(self.active.pixels, self.width, colors, dither), colors)
+        self.make_opaque(data)
+        # 抜き色のドットはそのまま残す
+        for start, end in mask_runs(self.match_mask(fullrect, self.transparent)):
+            data[start * 3:end * 3] = self.transparent * (end - start)
+        instroke = self.journal.recording()
+        self.journal.begin()
+        self.write(0, data)
+        if not instroke:
+            self.journal.end()
+        self.notify(Rect(0, 0, self.width, self.height))
+
+    def make_opaque(self, data):
+        """ シート全体分のバイト列dataの中の抜き色のドットを、
+        少しだけ色を変えて見えるようにする """
+        opaque = self.encode(COLOR_TRANSPARENT)
+        for start, end in mask_runs(self.match_mask(Rect(0, 0, self.width, self.height),
+                                                    self.transparent, data)):
+            data[start * self.bpp:end * self.bpp] = opaque * (end - start)
+
+    def snapshot(self):
+        """ 保存用に今のシートをコピーする\n
+        コピーした後は保存が終わるのを待たずに編集を続けてよい """
+        return bytes(self.pixels), list(self.colors)
+
+    def save_snapshot(self, snapshot, filename):
+        """ snapshot()でコピーしたシートを画像ファイルに保存する（別スレッドから呼んでよい）\n
+        パレットの番号で持っているときは8bitのパレット付きpngになる """
+        pixels, colors = snapshot
+        surface = pygame.image.frombuffer(pixels, (self.width, self.height),
+                                          "P" if self.indexed else "RGB")
+        if self.indexed:
+            surface.set_palette(colors)
+        pygame.image.save(surface, filename)
+
+    def save(self, filename):
+        """ シートを画像ファイルに保存する\n
+        レイヤーは重ねた結果を1枚の画像にする """
+        self.save_snapshot(self.snapshot(), filename)
+
+    def decode(self, filename, progress=None):
+        """ 画像ファイルを読み込んで、レイヤー1枚分のバイト列にして返す
+        （別スレッドから呼んでよい）\n
+        シートより大きい部分は切り捨て、足りない部分は白にする\n
+        progressを渡すと進み具合(0〜100)を引数に呼ぶ """
+        image = pygame.image.load(filename)
+        if progress is not None:
+            progress(30)
+        # シートより大きい部分は先に切り捨てる
+        if image.get_width() > self.width or image.get_height() > self.height:
+            image = image.subsurface(Rect(0, 0, min(image.get_width(), self.width),
+                                          min(image.get_height(), self.height)))
+        dither = "nearest" if self.quantize == "off" else self.quantize
+        if not self.indexed:
+            data = pygame.image.tobytes(image, "RGB")
+            if self.quantize != "off":
+                # パレットの色に減色
+                data = indices_to_rgb(quantize(data, image.get_width(), self.colors, dither),
+                                      self.colors)
+        elif image.get_bitsize() == 8 and [tuple(col)[:3] for col in
+                                           image.get_palette()[:len(self.colors)]] == self.colors:
+            # 同じパレットで保存した画像は番号をそのまま使う
+            data = pygame.image.tobytes(image, "P")
+        else:
+            # パレットの番号に減色
+            data = quantize(pygame.image.tobytes(image, "RGB"), image.get_width(),
+                            self.colors, dither)
+        if progress is not None:
+            progress(80)
+
+        if image.get_size() == (self.width, self.height):
+            pixels = bytearray(data)
+        else:
+            bpp = self.bpp
+            pixels = bytearray(self.encode(COLOR_WHITE)) * (self.width * self.height)
+            rowsize = min(image.get_width(), self.width) * bpp
+            for posy in range(min(image.get_height(), self.height)):
+                index = posy * image.get_width() * bpp
+                pixels[posy * self.width * bpp:posy * self.width * bpp + rowsize] = \
+                    data[index:index + rowsize]
+        self.make_opaque(pixels)
+        return pixels
+
+    def set_data(self, pixels):
+        """ decode()で作ったバイト列を1枚だけのレイヤーにして、シートを置き換える """
+        self.reset_layers()
+        self.active.pixels[:] = pixels
+        # 別のファイルになるので元に戻す記録は消す
+        self.journal.clear()
+        self.notify(Rect(0, 0, self.width, self.height))
+
+    def load(self, filename):
+        """ 画像ファイルを読み込む """
+        self.set_data(self.decode(filename))
+
+class AutoSave:
+    """ 自動保存（クラッシュしたときの復元用の記録）\n
+    前回から変更されたブロックだけをzlibで圧縮して記録ファイルの後ろに追加していく\n
+    ファイルは ヘッダー(AUTOSAVE_HEADER) と
+    レコード(AUTOSAVE_RECORD: シートの番号, ブロックの番号, 圧縮したサイズ) + 圧縮したブロック
+    の並び\n
+    編集中のシートのほかに、プロジェクトの他のシートの保存していない変更と、
+    ドキュメントの情報（ファイル名, 編集中のシートの番号, シート数）も記録する\n
+    記録が大きくなったら全ブロックを書いた一時ファイルを作り、os.replaceで置き換える\n
+    ファイルへの書き込みと圧縮は別スレッドで行う\n
+    記録ファイルは起動したエディタごとに別のファイルにし、同じ名前の.lockファイルを
+    ロックしておく（ロックできる記録ファイルは、落ちたエディタが残したもの） """
+    def __init__(self, directory, sheet, document=None):
+        self.directory = directory      # 記録ファイルを置くフォルダ
+        name = f"autosave-{os.getpid()}-{time.time_ns()}"
+        self.filename = os.path.join(directory, name + ".journal")
+                                        # 記録ファイル名（エディタごとに別の名前）
+        self.lock = None                # 記録ファイルのロック（.lockファイルを開いたもの）
+        self.orphan = None              # 落ちたエディタが残した記録 (記録ファイル名, ロック)
+        self.sheet = sheet              # 記録するシート（全レイヤーを重ねた結果を記録する）
+        self.document = document        # 記録するドキュメントの情報を返す関数
+                                        #   (情報の辞書, {シートの番号: {ブロックの番号:
+                                        #    圧縮したブロック}}) を返す
+        self.info = None                # 記録ファイルに書いたドキュメントの情報
+        self.journaled = {}             # 記録ファイルに書いた他のシートのブロック
+                                        #   {(シートの番号, ブロックの番号): 圧縮したブロック}
+        self.dirty_blocks = set()       # 前回の記録から変更されたブロックの番号
+        self.full = True                # 次は全ブロックを書き直すか？
+        self.written = 0                # 全ブロックを書き直してから追加したバイト数（圧縮前）
+        self.enabled = False            # 記録するか？（復元するか決まるまでは記録しない）
+        self.worker = ThreadPoolExecutor(max_workers=1)  # ファイルに書き込むスレッド
+        sheet.add_listener(self.sheet_changed)
+
+    def sheet_changed(self, rect):
+        """ シートの変更通知 変更されたブロックを覚えておく """
+        self.dirty_blocks.update(self.sheet.get_blocks_in_rect(rect))
+
+    def find_orphan(self):
+        """ 落ちたエディタが残した記録を探す（一番新しいもの）\n
+        見つかったときはロックしてorphanに入れ、Trueを返す """
+        if not os.path.isdir(self.directory):
+            return False
+        journals = sorted(glob.glob(os.path.join(self.directory, "autosave-*.journal")),
+                          key=os.path.getmtime, reverse=True)
+        for journal in journals:
+            lock = open_lock(os.path.splitext(journal)[0] + ".lock")
+            if lock is not None:
+                self.orphan = (journal, lock)
+                return True
+        return False
+
+    def start(self, restore=False):
+        """ 記録を始める\n
+        restoreがTrueのときは落ちたエディタが残した記録を復元して、その記録ファイルを引き継ぐ
+        （Falseのときは残した記録を消す）\n
+        復元したときは (ドキュメントの情報, 他のシートの変更) を返す """
+        os.makedirs(self.directory, exist_ok=True)
+        self.lock = open_lock(os.path.splitext(self.filename)[0] + ".lock")
+        self.enabled = True
+        if self.orphan is not None:
+            journal, lock = self.orphan
+            self.orphan = None
+            restored = self.read(journal) if restore else None
+            try:
+                if restored is not None:
+                    os.replace(journal, self.filename)
+                else:
+                    os.remove(journal)
+            except OSError:
+                pass
+            close_lock(lock)
+            if restored is not None:
+                pixels, info, edits = restored
+                self.sheet.set_data(pixels)
+                # 記録ファイルは次に変更したときに全ブロックを書き直すまでそのまま残す
+                self.dirty_blocks.clear()
+                self.full = True
+                return info, edits
+        self.reset()
+        return None
+
+    def get_document(self):
+        """ 記録するドキュメントの情報と、他のシートの保存していない変更 """
+        if self.document is None:
+            return {"filename": None, "sheet": 0, "count": 0}, {}
+        return self.document()
+
+    def header(self):
+        """ 記録ファイルのヘッダー """
+        sheet = self.sheet
+        return AUTOSAVE_HEADER.pack(b"DOTJ", sheet.width, sheet.height, sheet.bpp,
+                                    sheet.editcelx, sheet.editcely, sheet.blockx, sheet.blocky)
+
+    def read(self, filename):
+        """ 記録ファイルから (編集中のシート全体のバイト列, ドキュメントの情報,
+        他のシートの変更) を復元する\n
+        シートのサイズが違うときや、読めないときはNoneを返す
+        （書き込み中に落ちた最後のレコードは無視する） """
+        sheet = self.sheet
+        try:
+            with open(filename, "rb") as file:
+                data = file.read()
+        except OSError:
+            return None
+        if data[:AUTOSAVE_HEADER.size] != self.header():
+            return None
+        info = {"filename": None, "sheet": 0, "count": 0}
+        chunks = {}                     # 後のレコードで上書きしていく
+        index = AUTOSAVE_HEADER.size
+        while index + AUTOSAVE_RECORD.size <= len(data):
+            sheetindex, block, size = AUTOSAVE_RECORD.unpack_from(data, index)
+            index += AUTOSAVE_RECORD.size
+            if index + size > len(data) or \
+                    sheetindex != AUTOSAVE_META and block >= sheet.blockx * sheet.blocky:
+                break
+            chunk = data[index:index + size]
+            try:
+                blockdata = zlib.decompress(chunk)
+                if sheetindex == AUTOSAVE_META:
+                    info = json.loads(blockdata.decode("utf-8"))
+            except (zlib.error, ValueError):
+                break
+            index += size
+            if sheetindex != AUTOSAVE_META:
+                chunks[(sheetindex, block)] = chunk
+        pixels = bytearray(sheet.encode(COLOR_WHITE)) * (sheet.width * sheet.height)
+        edits = {}
+        for (sheetindex, block), chunk in chunks.items():
+            if sheetindex == info["sheet"]:
+                set_block_bytes(pixels, sheet.width, sheet.bpp, sheet.get_block_rect(block),
+                                zlib.decompress(chunk))
+            else:
+                edits.setdefault(sheetindex, {})[block] = chunk
+        return pixels, info, edits
+
+    def reset(self, clear=True):
+        """ 記録ファイルを消して、次の記録では全ブロックを書き直す\n
+        保存したときや別のファイルを読み込んだときに呼ぶ\n
+        clearがFalseのときは、まだ記録していない変更を残す
+        （保存中に変更されたかもしれないとき） """
+        if clear:
+            self.dirty_blocks.clear()
+        self.full = True
+        self.info = None
+        self.journaled = {}
+        self.worker.submit(self.remove_file)
+
+    def checkpoint(self):
+        """ 変更されたブロックと、まだ記録していない他のシートの変更を記録する\n
+        ブロックのコピーだけをここで行い、圧縮と書き込みは別スレッドで行う
+        （他のシートの変更は圧縮済みなのでそのまま書く） """
+        if not self.enabled:
+            return
+        info, edits = self.get_document()
+        others = [(sheetindex, block, chunk)
+                  for sheetindex, blocks in edits.items() if sheetindex != info["sheet"]
+                  for block, chunk in blocks.items()]
+        unjournaled = [(sheetindex, block, chunk) for sheetindex, block, chunk in others
+                       if self.journaled.get((sheetindex, block)) is not chunk]
+        if not self.dirty_blocks and not unjournaled:
+            return
+        sheet = self.sheet
+        meta = None if info == self.info else json.dumps(info).encode("utf-8")
+        blocksize = sheet.editcelx * sheet.editcely * sheet.bpp
+        if self.full or self.written + len(self.dirty_blocks) * blocksize \
+                + sum(len(chunk) for _, _, chunk in unjournaled) \
+                > len(sheet.pixels) * AUTOSAVE_COMPACT:
+            # 全ブロックを書き直す（シートは丸ごと1回でコピーする）
+            self.worker.submit(self.write_full, json.dumps(info).encode("utf-8"), others,
+                               info["sheet"], bytes(sheet.pixels))
+            self.full = False
+            self.written = 0
+            self.journaled = {(sheetindex, block): chunk for sheetindex, block, chunk in others}
+        else:
+            blocks = [(block, get_block_bytes(sheet.pixels, sheet.width, sheet.bpp,
+                                              sheet.get_block_rect(block)))
+                      for block in sorted(self.dirty_blocks)]
+            self.worker.submit(self.append_blocks, meta, unjournaled, info["sheet"], blocks)
+            self.written += len(blocks) * blocksize + \
+                sum(len(chunk) for _, _, chunk in unjournaled)
+            self.journaled.update(((sheetindex, block), chunk)
+                                  for sheetindex, block, chunk in unjournaled)
+        self.info = info
+        self.dirty_blocks.clear()
+
+    def close(self):
+        """ 最後の記録を書いて、書き込みが終わるまで待つ（終了するときに呼ぶ）\n
+        ロックを外すので、保存していない変更は次に起動したときに復元できる """
+        self.checkpoint()
+        self.worker.shutdown(wait=True)
+        if self.lock is not None:
+            close_lock(self.lock)
+            self.lock = None
+
+    def remove_file(self):
+        """ 記録ファイルを消す（別スレッドで実行される） """
+        try:
+            os.remove(self.filename)
+        except FileNotFoundError:
+            pass
+
+    def make_records(self, meta, chunks, sheetindex, blocks):
+        """ 記録ファイルに書くレコードのリストを作る（別スレッドで実行される）\n
+        metaはドキュメントの情報(json)かNone、chunksは他のシートの
+        (シートの番号, ブロックの番号, 圧縮したブロック)のリスト、
+        blocksは編集中のシートの(ブロックの番号, バイト列)のリスト """
+        records = []
+        if meta is not None:
+            compressed = zlib.compress(meta)
+            records.append(AUTOSAVE_RECORD.pack(AUTOSAVE_META, 0, len(compressed)))
+            records.append(compressed)
+        for chunksheet, block, chunk in chunks:
+            records.append(AUTOSAVE_RECORD.pack(chunksheet, block, len(chunk)))
+            records.append(chunk)
+        for block, blockdata in blocks:
+            compressed = zlib.compress(blockdata, 1)
+            records.append(AUTOSAVE_RECORD.pack(sheetindex, block, len(compressed)))
+            records.append(compressed)
+        return records
+
+    def append_blocks(self, meta, chunks, sheetindex, blocks):
+        """ レコードを記録ファイルの後ろに追加する（別スレッドで実行される） """
+        records = self.make_records(meta, chunks, sheetindex, blocks)
+        with open(self.filename, "ab") as file:
+            file.write(b"".join(records))
+            file.flush()
+            os.fsync(file.fileno())
+
+    def write_full(self, meta, chunks, sheetindex, pixels):
+        """ ドキュメントの情報、他のシートの変更と、編集中のシートの全ブロックを書いた
+        一時ファイルを作り、記録ファイルと置き換える（別スレッドで実行される） """
+        sheet = self.sheet
+        blocks = [(block, get_block_bytes(pixels, sheet.width, sheet.bpp,
+                                          sheet.get_block_rect(block)))
+                  for block in range(sheet.blockx * sheet.blocky)]
+        records = [self.header()] + self.make_records(meta, chunks, sheetindex, blocks)
+        tempname = self.filename + ".tmp"
+        with open(tempname, "wb") as file:
+            file.write(b"".join(records))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tempname, self.filename)
+
+class ProjectFile:
+    """ 複数のシートをまとめたプロジェクトファイル（.dotp）\n
+    ファイルは ヘッダー(PROJECT_HEADER), パレット(r, g, b の並び),
+    シートごとの索引 (PROJECT_SHEET, 名前, メタデータ(json), ブロックの数だけPROJECT_CHUNK) と、
+    ブロックごとにzlibで圧縮したチャンクの並び\n
+    開くときはmmapして索引だけを読み、チャンクは使うときに展開する
+    （読み込みは別スレッドから行う） """
+    def __init__(self, filename):
+        self.filename = filename        # プロジェクトファイル名
+        with open(filename, "rb") as file:
+            self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                                        # ファイル全体をmmapしたもの
+        try:
+            self.read_index()
+        except (ValueError, struct.error, UnicodeDecodeError):
+            self.close()
+            raise ValueError("not a project file")
+
+    def read_index(self):
+        """ ヘッダーとシートの索引を読む """
+        data = self.data
+        magic, version, editcelx, editcely, blockx, blocky, bpp, ncolors, nsheets = \
+            PROJECT_HEADER.unpack_from(data, 0)
+        if magic != b"DOTP" or version != PROJECT_VERSION:
+            raise ValueError("not a project file")
+        self.size = (editcelx, editcely, blockx, blocky)    # シートのサイズ
+        self.bpp = bpp                  # 1ドットのバイト数
+        index = PROJECT_HEADER.size
+        self.colors = [tuple(data[index + i * 3:index + i * 3 + 3]) for i in range(ncolors)]
+                                        # パレットの色(r, g, b)のリスト
+        index += ncolors * 3
+        self.sheets = []                # シートの索引のリスト
+                                        #   (名前, メタデータ, [(チャンクの位置, サイズ), ...])
+        for _ in range(nsheets):
+            namesize, metasize = PROJECT_SHEET.unpack_from(data, index)
+            index += PROJECT_SHEET.size
+            name = data[index:index + namesize].decode("utf-8")
+            index += namesize
+            meta = json.loads(data[index:index + metasize].decode("utf-8"))
+            index += metasize
+            chunks = [PROJECT_CHUNK.unpack_from(data, index + i * PROJECT_CHUNK.size)
+                      for i in range(blockx * blocky)]
+            index += blockx * blocky * PROJECT_CHUNK.size
+            if any(offset + size > len(data) for offset, size in chunks):
+                raise ValueError("broken project file")
+            self.sheets.append((name, meta, chunks))
+
+    def check(self, sheet):
+        """ sheetで開けるプロジェクトか確かめる（サイズか1ドットのバイト数が違うときはValueError） """
+        if self.size != (sheet.editcelx, sheet.editcely, sheet.blockx, sheet.blocky) \
+                or self.bpp != sheet.bpp:
+            raise ValueError("sheet size mismatch")
+
+    def read_chunk(self, index, block):
+        """ index番目のシートのブロックの圧縮したままのチャンクを返す """
+        offset, size = self.sheets[index][2][block]
+        return self.data[offset:offset + size]
+
+    def read_block(self, index, block):
+        """ index番目のシートのブロックを展開して返す """
+        return zlib.decompress(self.read_chunk(index, block))
+
+    def read_image(self, index):
+        """ index番目のシートを1枚のSurfaceにする（サムネイル用） """
+        editcelx, editcely, blockx, blocky = self.size
+        width, height = editcelx * blockx, editcely * blocky
+        pixels = bytearray(width * height * self.bpp)
+        for block in range(blockx * blocky):
+            rect = Rect(block // blocky * editcelx, block % blocky * editcely, editcelx, editcely)
+            set_block_bytes(pixels, width, self.bpp, rect, self.read_block(index, block))
+        image = pygame.image.frombuffer(pixels, (width, height), "P" if self.bpp == 1 else "RGB")
+        if self.bpp == 1:
+            image.set_palette(self.colors)
+        return image
+
+    def close(self):
+        """ mmapを閉じる """
+        self.data.close()
+
 class SubScreen:
     """ サブスクリーン\n
     サブスクリーンの基本クラス """
     def __init__(self, name, rect, mainscreen):
+        self.group = None                           # 追加されたSubScreenGroup
         self.name = name                            # サブスクリーンの画面名
         self.rect = rect                            # サブスクリーンのrect
         self.mainscreen = mainscreen                # メイン画面の参照
@@ -39,15 +995,46 @@ class SubScreen:
         self.visible = True                         # サブスクリーンを表示するか？
         self.lock = False                           # サブスクリーンをロックするか？
         self.updateflg = False                      # サブスクリーンが更新されたか？
+    @property
+    def screenlevel(self):
+        """ サブスクリーンの重なる順番 """
+        return self._screenlevel
+    @screenlevel.setter
+    def screenlevel(self, value):
+        self._screenlevel = value
+        if self.group is not None:
+            self.group.hit_order = None             # 重なり順の作り直し
+    @property
+    def visible(self):
+        """ サブスクリーンを表示するか？ """
+        return self._visible
+    @visible.setter
+    def visible(self, value):
+        self._visible = value
+        if self.group is not None:
+            self.group.hit_order = None             # 重なり順の作り直し
     def update(self):
         """ サブスクリーンの更新 """
         self.updateflg = True
     def mouse_button_down(self, pos, button):
         """ ボタンが押されたときの処理 """
+    def mouse_button_up(self, pos, button):
+        """ ボタンが離されたときの処理\n
+        ボタンを押したサブスクリーンに、画面外で離しても通知される """
     def mouse_motion(self, pos, ref, buttons):
         """ マウスが移動したときの処理 """
+    def mouse_stroke(self, points, buttons):
+        """ 1フレーム分まとめたマウスの移動の処理\n
+        pointsは移動前の位置から今の位置までのサブスクリーン上の座標のリスト\n
+        標準では今の位置でmouse_motionを呼ぶ """
+        self.mouse_motion(points[-1], (points[-1][0] - points[0][0],
+                                       points[-1][1] - points[0][1]), buttons)
+    def key_down(self, key, mod):
+        """ キーが押されたときの処理\n
+        モーダル画面として表示しているときだけ通知される """
     def draw(self):
-        """ サブスクリーンの描画 """
+        """ サブスクリーンの描画\n
+        一部だけ描き直したときは、メイン画面上のRectを返す（Noneのときはサブスクリーン全体） """
         self.screen.fill(COLOR_WHITE)
         pygame.draw.rect(self.screen, COLOR_BLACK, (0, 0, self.rect.width, self.rect.height), 6)
         self.mainscreen.blit(self.screen, self.rect)
@@ -55,18 +1042,75 @@ class SubScreen:
 class SubScreenGroup:
     """ サブスクリーンクラスをまとめて管理する """
     def __init__(self, mainscreen, config):
-        self.sub_screens = []               # サブスクリーンをリストで管理
+        self.sub_screens = []               # サブスクリーンをリストで管理（描画順）
+        self.names = {}                     # 名前からサブスクリーンを引く辞書
+        self.hit_order = None               # 表示中のサブスクリーンを上から順に並べたリスト
+                                            #   表示、重なり順が変わったらNoneにして作り直す
         self.mainscreen = mainscreen        # メインスクリーンにアクセスできるように
         self.config = config                # configparser
+        self.allupdate = True               # メイン画面全体を画面に反映するか？
+        self.grab = None                    # ボタンが押されたサブスクリーン
+        self.motion_points = []             # まとめて処理するマウスの位置
+                                            #   （移動前の位置から順に）
+        self.motion_buttons = (0, 0, 0)     # マウス移動中のボタンの状態
+        self.modal = None                   # 表示中のモーダル画面（他の画面はロックする）
 
     def append(self, subscreen):
         """ サブスクリーンオブジェクトを追加 """
         self.sub_screens.append(subscreen)
+        self.names[subscreen.name] = subscreen
+        subscreen.group = self
+        self.hit_order = None
 
     def get_subscreen(self, name):
         """ サブスクリーンの取得 """
-        for subscreen in self.sub_screens:
-            if subscreen.name == name:
+        return self.names.get(name)
+
+    def is_dirty(self):
+        """ 描き直す画面か、まだ処理していないマウスの移動があるか？ """
+        return self.allupdate or bool(self.motion_points) or\
+            any(subscreen.visible and subscreen.updateflg for subscreen in self.sub_screens)
+
+    def open_modal(self, modal):
+        """ modalの画面を表示して、他の画面をロックする """
+        self.modal = modal
+        for screen in self.sub_screens:
+            if screen is modal:
+                screen.visible = True
+                screen.updateflg = True
+            else:
+                screen.lock = True
+
+    def close_modal(self):
+        """ 表示中のモーダル画面を閉じて、他の画面のロックを解除する """
+        self.modal.visible = False
+        self.modal = None
+        for screen in self.sub_screens:
+            screen.lock = False
+        # 全画面の更新
+        userevent = pygame.event.Event(USEREVENT_ALLUPDATE)
+        pygame.event.post(userevent)
+
+    def open_msgbox(self, msgbox_type, msgs, callback=None, value=None):
+        """ メッセージボックスを表示する\n
+        閉じたときにcallbackに戻り値（YES/NOはTrue/False、インプットボックスは
+        入力値、キャンセルはFalse）を渡して呼ぶ """
+        msgbox = self.get_subscreen("MsgBox")
+        msgbox.open(msgbox_type, msgs, callback, value)
+        self.open_modal(msgbox)
+
+    def get_subscreen_at(self, pos):
+        """ posが指しているサブスクリーンの取得\n
+        重なっているときは一番上（screenlevelが大きい）のサブスクリーンを返す\n
+        サブスクリーンが無いときはNoneを返す """
+        if self.hit_order is None:
+            # 表示中のサブスクリーンを上から順に並べる
+            # 同じscreenlevelのときは先に追加したほうが上
+            self.hit_order = sorted((subscreen for subscreen in self.sub_screens
+                                     if subscreen.visible),
+                                    key=lambda subscreen: -subscreen.screenlevel)
+        for subscreen in self.hit_order:
+            if subscreen.rect.collidepoint(pos):
                 return subscreen
         return None
 
@@ -75,97 +1119,151 @@ class SubScreenGroup:
         サブスクリーンの名前とサブスクリーン上のposを返す\n
         サブスクリーンが無いときはNone（文字）を返す\n
         重なっているときはscreenlevelで判定"""
-        name = "None"
-        sposx = 0
-        sposy = 0
-        screenlevel = -1
-        for subscreen in self.sub_screens:
-            if subscreen.visible\
-                and subscreen.rect.collidepoint(pos)\
-                and screenlevel < subscreen.screenlevel:
-                # サブスクリーン上のposを計算
-                name = subscreen.name
-                sposx = pos[0] - subscreen.rect.x
-                sposy = pos[1] - subscreen.rect.y
-                screenlevel = subscreen.screenlevel
-
-        return name, sposx, sposy
+        subscreen = self.get_subscreen_at(pos)
+        if subscreen is None:
+            return "None", 0, 0
+        # サブスクリーン上のposを計算
+        return subscreen.name, pos[0] - subscreen.rect.x, pos[1] - subscreen.rect.y
+
+    def flush_motion(self):
+        """ まとめたマウスの移動を1回で処理する """
+        if not self.motion_points:
+            return
+        points = self.motion_points
+        self.motion_points = []
+        # ボタンを押したままならボタンを押したサブスクリーン、
+        # 押していなければ今の位置のサブスクリーンに通知
+        if self.grab is not None and any(self.motion_buttons):
+            subscreen = self.grab
+        else:
+            subscreen = self.get_subscreen_at(points[-1])
+        # 表示中かつロックされていない時だけ処理
+        if subscreen is not None and subscreen.visible and not subscreen.lock:
+            subscreen.mouse_stroke([(posx - subscreen.rect.x, posy - subscreen.rect.y)
+                                    for posx, posy in points], self.motion_buttons)
 
     def update(self):
         """ まとめて更新 """
+        self.flush_motion()
         for subscreen in self.sub_screens:
             # 表示中かつロックされていない画面のみ更新
             if subscreen.visible and not subscreen.lock:
                 subscreen.update()
 
-        # エディタ画面の絵をビュー画面に反映
-        if self.get_subscreen("EditScreen").updateflg:
-            for i, cell in enumerate(self.get_subscreen("ViewScreen").blocks[\
-                            self.get_subscreen("ViewScreen").select_block][1]):
-                cell[0] = tuple(self.get_subscreen("EditScreen").cells[i][0])
-            self.get_subscreen("ViewScreen").updateflg = True
+        editscreen = self.get_subscreen("EditScreen")
+        viewscreen = self.get_subscreen("ViewScreen")
+        palettscreen = self.get_subscreen("PalettScreen")
         # ビュー画面の選択ブロックをエディタ画面に反映
-        if self.get_subscreen("ViewScreen").updateflg:
-            for i, cell in enumerate(self.get_subscreen("EditScreen").cells):
-                cell[0] = tuple(self.get_subscreen("ViewScreen").blocks[\
-                                self.get_subscreen("ViewScreen").select_block][1][i][0])
-            self.get_subscreen("EditScreen").updateflg = True
+        if editscreen.select_block != viewscreen.select_block:
+            editscreen.set_block(viewscreen.select_block)
 
         # パレット画面の色選択をエディタ画面に反映
-        self.get_subscreen("EditScreen").drawcol1 = self.get_subscreen("PalettScreen").drawcol1
-        self.get_subscreen("EditScreen").drawcol2 = self.get_subscreen("PalettScreen").drawcol2
+        # （パレットから選んだ色はパレットの番号で渡す）
+        if palettscreen.drawindex1 is None:
+            editscreen.drawcol1 = palettscreen.drawcol1
+        else:
+            editscreen.drawcol1 = palettscreen.drawindex1
+        if palettscreen.drawindex2 is None:
+            editscreen.drawcol2 = palettscreen.drawcol2
+        else:
+            editscreen.drawcol2 = palettscreen.drawindex2
 
     def event_handler(self, event):
         """ イベントハンドラー\n
         各サブスクリーンのイベント処理を実行する """
+        # マウスの移動は1フレーム分まとめて処理する
+        if event.type == MOUSEMOTION:
+            if not self.motion_points:
+                # 移動前の位置
+                self.motion_points.append((event.pos[0] - event.rel[0],
+                                           event.pos[1] - event.rel[1]))
+            self.motion_points.append(event.pos)
+            self.motion_buttons = event.buttons
+            return
+        # 他のイベントより前の移動は先に処理する
+        self.flush_motion()
+
         # マウスがクリックされた時
         if event.type == MOUSEBUTTONDOWN:
-            # クリックされたサブスクリーン名を取得
-            name, posx, posy = self.get_subscreen_in_pos(event.pos)
-            for subscreen in self.sub_screens:
-                # 表示中かつロックされていない時だけ処理
-                if subscreen.name == name and subscreen.visible and not subscreen.lock:
-                    subscreen.mouse_button_down((posx, posy), event.button)
-        # マウスが移動
-        elif event.type == MOUSEMOTION:
-            # クリックされたサブスクリーン名を取得
-            name, posx, posy = self.get_subscreen_in_pos(event.pos)
-            for subscreen in self.sub_screens:
-                # 表示中かつロックされていない時だけ処理
-                if subscreen.name == name and subscreen.visible and not subscreen.lock:
-                    subscreen.mouse_motion((posx, posy), event.rel, event.buttons)
+            # クリックされたサブスクリーンを取得
+            subscreen = self.get_subscreen_at(event.pos)
+            # 表示中かつロックされていない時だけ処理
+            if subscreen is not None and not subscreen.lock:
+                self.grab = subscreen
+                subscreen.mouse_button_down((event.pos[0] - subscreen.rect.x,
+                                             event.pos[1] - subscreen.rect.y), event.button)
+        # マウスのボタンが離された時
+        elif event.type == MOUSEBUTTONUP:
+            # ボタンが押されたサブスクリーンに通知
+            if self.grab is not None:
+                self.grab.mouse_button_up((event.pos[0] - self.grab.rect.x,
+                                           event.pos[1] - self.grab.rect.y), event.button)
+                if not any(pygame.mouse.get_pressed()):
+                    self.grab = None
+        # キーが押された時
+        elif event.type == KEYDOWN:
+            # モーダル画面を表示中はその画面だけに通知
+            if self.modal is not None:
+                self.modal.key_down(event.key, event.mod)
+                self.modal.updateflg = True
+            # Ctrl+Zで元に戻す、Ctrl+Y（Ctrl+Shift+Z）でやり直す
+            elif event.mod & KMOD_CTRL:
+                if event.key == K_y or (event.key == K_z and event.mod & KMOD_SHIFT):
+                    pygame.event.post(pygame.event.Event(USEREVENT_MENU, {"menu_type": "menu_redo"}))
+                elif event.key == K_z:
+                    pygame.event.post(pygame.event.Event(USEREVENT_MENU, {"menu_type": "menu_undo"}))
+            # PageUp、PageDownでプロジェクトのシートを切り替える
+            elif event.key in (K_PAGEUP, K_PAGEDOWN):
+                self.get_subscreen("ViewScreen").select_sheet(-1 if event.key == K_PAGEUP else 1)
         # メニューバーの項目が押された時
         elif event.type == USEREVENT_MENU:
-            msgs = []
             if event.menu_type == "menu_clear":
-                msgs.clear()
-                msgs.append("edit clear?")
-                msgbox = MsgBox(MSGBOX_TYPE_YESNO, msgs, self.mainscreen)
-                if msgbox.return_value:
-                    self.get_subscreen("EditScreen").cells_clear()
+                def clear(answer):
+                    if answer:
+                        self.get_subscreen("EditScreen").cells_clear()
+                self.open_msgbox(MSGBOX_TYPE_YESNO, ["edit clear?"], clear)
             elif event.menu_type == "menu_clearall":
-                msgs.clear()
-                msgs.append("all clear?")
-                msgbox = MsgBox(MSGBOX_TYPE_YESNO, msgs, self.mainscreen)
-                if msgbox.return_value:
-                    self.get_subscreen("EditScreen").cells_clear()
-                    self.get_subscreen("ViewScreen").blocks_clear()
+                def clearall(answer):
+                    if answer:
+                        self.get_subscreen("ViewScreen").blocks_clear()
+                self.open_msgbox(MSGBOX_TYPE_YESNO, ["all clear?"], clearall)
             elif event.menu_type == "menu_save":
                 self.get_subscreen("ViewScreen").save()
             elif event.menu_type == "menu_load":
                 self.get_subscreen("ViewScreen").load()
+            elif event.menu_type == "menu_undo":
+                self.get_subscreen("EditScreen").sheet.undo()
+            elif event.menu_type == "menu_redo":
+                self.get_subscreen("EditScreen").sheet.redo()
+            elif event.menu_type[len("menu_"):] in EDIT_TOOLS:
+                # ツールの切り替え
+                tool = event.menu_type[len("menu_"):]
+                self.get_subscreen("EditScreen").tool = tool
+                menubar = self.get_subscreen("MenuBar")
+                menubar.selected -= set(EDIT_TOOLS)
+                menubar.selected.add(tool)
+                menubar.updateflg = True
+            elif event.menu_type == "menu_conn8":
+                # 塗りつぶしで斜めもつなげるかの切り替え
+                editscreen = self.get_subscreen("EditScreen")
+                editscreen.connect8 = not editscreen.connect8
+                menubar = self.get_subscreen("MenuBar")
+                menubar.selected ^= {"conn8"}
+                menubar.updateflg = True
             elif event.menu_type == "menu_palett":
-                for screen in self.sub_screens:
-                    if screen.name == "PalettSettingScreen":
-                        screen.visible = True
-                    else:
-                        screen.lock = True
+                palettsetting = self.get_subscreen("PalettSettingScreen")
+                palettsetting.closing = False
+                self.open_modal(palettsetting)
         # パレット設定画面
         elif event.type == USEREVENT_PALETTSETTING:
+            # 閉じた後に届いた2回目のイベントは無視する
+            if self.modal is None or self.modal is not self.get_subscreen("PalettSettingScreen"):
+                return
             # エディット画面のパレットに反映
             if event.palettset_type == "palettset_O K":
                 palett = self.get_subscreen("PalettSettingScreen").get_palett()
                 self.get_subscreen("PalettScreen").set_palett(palett)
+                self.get_subscreen("EditScreen").sheet.set_palett(palett)
                 # iniファイルの設定変更
                 for col in palett:
                     self.config.set("palettcolor", str(col[0]),
@@ -176,34 +1274,68 @@ class SubScreenGroup:
 
 
             # パレット画面を非表示にして、他の画面のロックを解除
-            for screen in self.sub_screens:
-                if screen.name == "PalettSettingScreen":
-                    screen.visible = False
-                else:
-                    screen.lock = False
-            # 全画面の更新
-            userevent = pygame.event.Event(USEREVENT_ALLUPDATE)
-            pygame.event.post(userevent)
+            self.close_modal()
+
+        # メッセージボックスか読み込みブラウザが閉じた時
+        elif event.type == USEREVENT_MSGBOX:
+            # 閉じた後に届いたイベントや、別の画面を開いた後に届いたイベントは無視する
+            if self.modal is None or self.modal is not event.screen:
+                return
+            self.close_modal()
+            if event.callback is not None:
+                event.callback(event.value)
+
+        # 保存、読み込みの状況
+        elif event.type == USEREVENT_FILE:
+            self.get_subscreen("ViewScreen").file_event(event)
+
+        # 読み込みブラウザのサムネイル
+        elif event.type == USEREVENT_THUMBNAIL:
+            self.get_subscreen("LoadBrowser").thumbnail_event(event)
+
+        # 自動保存
+        elif event.type == USEREVENT_AUTOSAVE:
+            self.get_subscreen("ViewScreen").autosave.checkpoint()
 
         # 全更新
         elif event.type == USEREVENT_ALLUPDATE:
             self.mainscreen.fill(COLOR_SILVER)
+            self.allupdate = True
             for subscreen in self.sub_screens:
                 subscreen.updateflg = True
 
     def draw(self):
-        """ まとめて描画 """
-        for subscreen in self.sub_screens:
-            # 表示中かつ更新した画面のみ描画
-            if subscreen.visible and subscreen.updateflg:
-                subscreen.draw()
+        """ まとめて描画\n
+        描画したRectのリストを返す（何も描画していないときは空のリスト） """
+        rects = []
+        drawn_rects = []                    # 描画した (screenlevel, メイン画面上のRect)
+        # 下の画面から順に描画する（同じscreenlevelのときは追加した順）
+        for subscreen in sorted(self.sub_screens, key=lambda subscreen: subscreen.screenlevel):
+            if not subscreen.visible:
+                continue
+            # 下の画面が描き直した範囲に重なっているときは、上の画面も描き直す
+            if not subscreen.updateflg and \
+                    any(level < subscreen.screenlevel and subscreen.rect.colliderect(rect)
+                        for level, rect in drawn_rects):
+                subscreen.updateflg = True
+            # 更新した画面のみ描画
+            if subscreen.updateflg:
+                drawn = subscreen.draw()
                 subscreen.updateflg = False
+                rect = subscreen.rect if drawn is None else drawn
+                rects.append(rect)
+                drawn_rects.append((subscreen.screenlevel, rect))
+        # メイン画面全体を塗り直したときは全体を反映
+        if self.allupdate:
+            self.allupdate = False
+            rects = [self.mainscreen.get_rect()]
+        return rects
 
 class MenuBar(SubScreen):
     """ メニューバー """
     def __init__(self, name, rect, mainscreen):
         super().__init__(name, rect, mainscreen)
-        self.font = pygame.font.SysFont(None, 20)
+        self.fontsize = 20
         self.celheight = 40                             # 1個のセルのサイズ
         self.celwidth = 55                              # 1個のセルのサイズ
         self.cells = []                                 # メニュー項目のリスト
@@ -219,6 +1351,41 @@ class MenuBar(SubScreen):
         self.cells.append(("clearall", cellrect))
         cellrect = Rect(250, 5, self.celwidth, self.celheight)      # パレットボタン
         self.cells.append(("palett", cellrect))
+        cellrect = Rect(324, 5, self.celwidth, self.celheight)      # 元に戻すボタン
+        self.cells.append(("undo", cellrect))
+        cellrect = Rect(381, 5, self.celwidth, self.celheight)      # やり直しボタン
+        self.cells.append(("redo", cellrect))
+        cellrect = Rect(455, 5, self.celwidth, self.celheight)      # ペンボタン
+        self.cells.append(("pen", cellrect))
+        cellrect = Rect(512, 5, self.celwidth, self.celheight)      # 塗りつぶしボタン
+        self.cells.append(("fill", cellrect))
+        cellrect = Rect(569, 5, self.celwidth, self.celheight)      # 色の置き換えボタン
+        self.cells.append(("replace", cellrect))
+        cellrect = Rect(626, 5, self.celwidth, self.celheight)      # 直線ボタン
+        self.cells.append(("line", cellrect))
+        cellrect = Rect(683, 5, self.celwidth, self.celheight)      # 四角形ボタン
+        self.cells.append(("rect", cellrect))
+        cellrect = Rect(740, 5, self.celwidth, self.celheight)      # 塗りつぶした四角形ボタン
+        self.cells.append(("fillrect", cellrect))
+        cellrect = Rect(797, 5, self.celwidth, self.celheight)      # 楕円ボタン
+        self.cells.append(("ellipse", cellrect))
+        cellrect = Rect(871, 5, self.celwidth, self.celheight)      # 斜めもつなげるボタン
+        self.cells.append(("conn8", cellrect))
+        self.hover = None                               # マウスカーソルが乗っている項目
+        self.selected = {"pen"}                         # 選択中（オン）の項目
+        self.updateflg = True
+
+    def update(self):
+        """ サブスクリーンの更新\n
+        マウスカーソルが乗っている項目が変わったときだけ描き直す """
+        posx, posy = pygame.mouse.get_pos()
+        hover = None
+        for cell in self.cells:
+            if cell[1].collidepoint((posx - self.rect.left, posy - self.rect.top)):
+                hover = cell[0]
+        if hover != self.hover:
+            self.hover = hover
+            self.updateflg = True
 
     def mouse_button_down(self, pos, button):
         """ ボタンが押されたときの処理 """
@@ -226,7 +1393,8 @@ class MenuBar(SubScreen):
             # ボタンが押された項目のイベントを発行
             for cell in self.cells:
                 if cell[1].collidepoint(pos):
-                    if cell[0] in ["save", "load", "clear", "clearall", "palett"]:
+                    if cell[0] in ["save", "load", "clear", "clearall", "palett",
+                                   "undo", "redo", "conn8", *EDIT_TOOLS]:
                         userevent = pygame.event.Event(USEREVENT_MENU,
                                                        {"menu_type": "menu_" + cell[0]})
                         pygame.event.post(userevent)
@@ -236,13 +1404,15 @@ class MenuBar(SubScreen):
         self.screen.fill(COLOR_GRAY)
         # メニュー項目の描画
         for cell in self.cells:
-            pygame.draw.rect(self.screen, COLOR_SILVER, cell[1])            # セルの色
-            self.screen.blit(self.font.render(cell[0], True, COLOR_BLACK),  # 項目名
+            if cell[0] in self.selected:
+                pygame.draw.rect(self.screen, COLOR_WHITE, cell[1])         # 選択中のセルの色
+            else:
+                pygame.draw.rect(self.screen, COLOR_SILVER, cell[1])        # セルの色
+            self.screen.blit(render_text(cell[0], self.fontsize, COLOR_BLACK),  # 項目名
                              (cell[1].left + 5, 10))
             pygame.draw.rect(self.screen, COLOR_BLACK, cell[1], 1)            # セルの枠
             # マウスカーソルが項目上にある場合は、枠を描画する
-            posx, posy = pygame.mouse.get_pos()
-            if cell[1].collidepoint((posx - self.rect.left, posy - self.rect.top)):
+            if cell[0] == self.hover:
                 pygame.draw.rect(self.screen, COLOR_BLACK, cell[1], 3)          # セルの枠
         # メニューバーの枠
         pygame.draw.rect(self.screen, COLOR_BLACK,
@@ -252,94 +1422,407 @@ class MenuBar(SubScreen):
 
 class EditScreen(SubScreen):
     """ エディタ部の画面 """
-    def __init__(self, name, rect, mainscreen):
+    def __init__(self, name, rect, mainscreen, sheet):
         super().__init__(name, rect, mainscreen)
-        self.editcelx = 32              # 32 x 32 のドット絵を書く
-        self.editcely = 32
-        self.cellsize = 15               # 1個のセルのサイズ
-        self.drawcol1 = COLOR_BLACK     # クリックした場所に塗る色１
+        self.sheet = sheet              # 編集するシート
+        self.editcelx = sheet.editcelx  # 32 x 32 のドット絵を書く
+        self.editcely = sheet.editcely
+        self.viewsize = (rect.width - 6, rect.height - 6)   # セルを描く範囲のサイズ
+        self.cellsize = max(1, min(self.viewsize) // max(self.editcelx, self.editcely))
+                                        # 1個のセルのサイズ（拡大率 32 x 32 のときは15）
+        self.maxcellsize = 64           # 一番大きく拡大したときのセルのサイズ
+        self.origin = (0, 0)            # 左上に表示するセル
+        self.pan = None                 # 中ボタンでドラッグ中の (押した位置, そのときのorigin)
+        self.drawcol1 = COLOR_BLACK     # クリックした場所に塗る色１ (r, g, b)かパレットの番号
         self.drawcol2 = COLOR_WHITE     # クリックした場所に塗る色２
-        self.cells = []                 # １ドット情報のリスト
-                                        # １ドットは (color, rect)
-        # 全セルのRectと色（白）を設定
-        self.cells_clear()
+        self.select_block = 0           # 編集中のブロック
+        self.block_rect = sheet.get_block_rect(self.select_block)  # 編集中ブロックのシート上のRect
+        self.tool = "pen"               # ツール pen（ペン）, fill（塗りつぶし）,
+                                        #   replace（シート全体で同じ色を置き換え）,
+                                        #   line, rect, fillrect, ellipse（図形）
+        self.connect8 = False           # 塗りつぶしで斜めもつながっているとみなすか？
+        self.shape = None               # ドラッグ中の図形 (ツール, 始点のセル, 終点のセル, 色)
+        self.overlay = pygame.Surface(rect.size, SRCALPHA)  # 図形のプレビューを描く透明な画面
+        self.preview_rect = None        # overlayにプレビューを描いた範囲
+        self.preview_dirty = False      # プレビューだけ描き直すか？
+        self.grid = None                # 表示範囲＋1セル分のセルの枠を描いておく画面
+                                        #   表示位置が変わっても同じものを重ねるだけにする
+        self.grid_key = None            # gridを描いたときのcellsize
+                                        #   拡大率が変わったら描き直す
+        self.dirty_rect = Rect(0, 0, self.editcelx, self.editcely) # 描画し直すセルの範囲
+        self.updateflg = True
+        sheet.add_listener(self.sheet_changed)
 
-    def mouse_button_down(self, pos, button):
-        """ ボタンが押されたときの処理 """
-        for cell in self.cells:
-            # ボタンが押されたセルの色を変更
-            if cell[1].collidepoint(pos):
-                if button == BUTTON_LEFT:
-                    cell[0] = self.drawcol1
-                elif button == BUTTON_RIGHT:
-                    cell[0] = self.drawcol2
-                self.updateflg = True               # 更新フラグセット
+    def set_block(self, index):
+        """ 編集するブロックを切り替える """
+        self.select_block = index
+        self.block_rect = self.sheet.get_block_rect(index)
+        self.dirty_rect = Rect(0, 0, self.editcelx, self.editcely)
+        self.updateflg = True
 
-    def mouse_motion(self, pos, ref, buttons):
-        """ マウスが移動したときの処理 """
-        for cell in self.cells:
+    def sheet_changed(self, rect):
+        """ シートの変更通知 編集中ブロックに掛かる範囲だけ描画し直す """
+        changed = self.block_rect.clip(rect)
+        if changed.width and changed.height:
+            changed.move_ip(-self.block_rect.left, -self.block_rect.top)
+            if self.dirty_rect is None:
+                self.dirty_rect = changed
+            else:
+                self.dirty_rect.union_ip(changed)
+            self.updateflg = True
+
+    def pos_to_cell(self, pos):
+        """ posの位置のセルの座標(x, y) ブロックの外の座標にもなる """
+        return ((pos[0] - 3) // self.cellsize + self.origin[0],
+                (pos[1] - 3) // self.cellsize + self.origin[1])
+
+    def cell_to_pos(self, cellx, celly):
+        """ セルの左上のサブスクリーン上の位置 """
+        return ((cellx - self.origin[0]) * self.cellsize + 3,
+                (celly - self.origin[1]) * self.cellsize + 3)
+
+    def get_cell_in_pos(self, pos):
+        """ posが指しているセルの座標(x, y)を取得\n
+        セルが無いときはNoneを返す """
+        cellx, celly = self.pos_to_cell(pos)
+        if 0 <= cellx < self.editcelx and 0 <= celly < self.editcely:
+            return cellx, celly
+        return None
+
+    def get_visible_rect(self):
+        """ 表示しているセルの範囲（ブロック上のRect） """
+        return Rect(self.origin, (-(-self.viewsize[0] // self.cellsize),
+                                  -(-self.viewsize[1] // self.cellsize))).clip(
+                                      Rect(0, 0, self.editcelx, self.editcely))
+
+    def set_view(self, cellsize, origin):
+        """ 拡大率と左上に表示するセルを設定する\n
+        ブロックの外が見えすぎないように位置を調整する """
+        cellsize = min(max(cellsize, 1), self.maxcellsize)
+        originx = min(max(origin[0], 0),
+                      max(0, self.editcelx - self.viewsize[0] // cellsize))
+        originy = min(max(origin[1], 0),
+                      max(0, self.editcely - self.viewsize[1] // cellsize))
+        if (cellsize, (originx, originy)) != (self.cellsize, self.origin):
+            self.cellsize = cellsize
+            self.origin = (originx, originy)
+            self.dirty_rect = Rect(0, 0, self.editcelx, self.editcely)
+            self.updateflg = True
+
+    def zoom(self, pos, zoomin):
+        """ posの位置のセルが動かないように拡大(zoomin=True)、縮小する """
+        if zoomin:
+            cellsize = self.cellsize + max(1, self.cellsize // 4)
+        else:
+            cellsize = self.cellsize - max(1, self.cellsize // 5)
+        cellsize = min(max(cellsize, 1), self.maxcellsize)
+        cellx, celly = self.pos_to_cell(pos)
+        self.set_view(cellsize, (cellx - (pos[0] - 3) // cellsize,
+                                 celly - (pos[1] - 3) // cellsize))
+
+    def get_pixel(self, cellx, celly):
+        """ セルの色を(r, g, b)で取得 """
+        return self.sheet.get_pixel(self.block_rect.left + cellx, self.block_rect.top + celly)
+
+    def set_pixel(self, cellx, celly, col):
+        """ セルの色を設定 """
+        self.sheet.set_pixels([(self.block_rect.left + cellx, self.block_rect.top + celly)], col)
+
+    def mouse_button_down(self, pos, button):
+        """ ボタンが押されたときの処理\n
+        ホイールで拡大縮小、中ボタンのドラッグで表示位置の移動 """
+        if button in (BUTTON_WHEELUP, BUTTON_WHEELDOWN):
+            self.zoom(pos, button == BUTTON_WHEELUP)
+            return
+        if button == BUTTON_MIDDLE:
+            self.pan = (pos, self.origin)
+            return
+        if button in (BUTTON_LEFT, BUTTON_RIGHT):
+            self.sheet.begin_stroke()       # ボタンを離すまでを1回の元に戻す単位にする
+        cell = self.get_cell_in_pos(pos)
+        if cell is None:
+            return
+        if button == BUTTON_LEFT:
+            col = self.drawcol1
+        elif button == BUTTON_RIGHT:
+            col = self.drawcol2
+        else:
+            return
+        posx = self.block_rect.left + cell[0]
+        posy = self.block_rect.top + cell[1]
+        if self.tool in SHAPE_TOOLS:
+            # ボタンを離すまではプレビューだけ描く
+            self.shape = (self.tool, cell, cell, col)
+            self.preview_dirty = True
+            self.updateflg = True
+        elif self.tool == "fill":
+            # 編集中のブロックの中で塗りつぶし
+            self.sheet.flood_fill(posx, posy, col, self.block_rect, self.connect8)
+        elif self.tool == "replace":
+            # シート全体で同じ色を置き換え
+            self.sheet.replace_color(posx, posy, col)
+        else:
             # ボタンが押されたセルの色を変更
-            if cell[1].collidepoint(pos):
-                if buttons[0]:
-                    cell[0] = self.drawcol1
-                    self.updateflg = True               # 更新フラグセット
-                elif buttons[2]:
-                    cell[0] = self.drawcol2
-                    self.updateflg = True               # 更新フラグセット
+            self.set_pixel(cell[0], cell[1], col)
+
+    def mouse_button_up(self, pos, button):
+        """ ボタンが離されたときの処理 """
+        if button == BUTTON_MIDDLE:
+            self.pan = None
+        if button in (BUTTON_LEFT, BUTTON_RIGHT):
+            if self.shape is not None:
+                # 図形をシートに書き込む
+                self.sheet.set_pixels([(self.block_rect.left + cellx,
+                                        self.block_rect.top + celly)
+                                       for cellx, celly in self.shape_cells()],
+                                      self.shape[3])
+                self.shape = None
+                self.preview_dirty = True
+                self.updateflg = True
+            self.sheet.end_stroke()
+
+    def mouse_stroke(self, points, buttons):
+        """ 1フレーム分まとめたマウスの移動の処理\n
+        移動した点の間を直線でつなぎ、まとめてシートに書き込む\n
+        図形のツールのときは終点を動かしてプレビューを描き直す """
+        if self.pan is not None:
+            if buttons[1]:
+                # 押した位置からの移動量だけ表示位置をずらす
+                # （左上にも右下にも1セル分動かしたときにずれるように0に向かって切り捨てる）
+                start, origin = self.pan
+                pos = points[-1]
+                self.set_view(self.cellsize,
+                              (origin[0] - int((pos[0] - start[0]) / self.cellsize),
+                               origin[1] - int((pos[1] - start[1]) / self.cellsize)))
+            return
+        if self.shape is not None:
+            end = self.pos_to_cell(points[-1])
+            if end != self.shape[2]:
+                self.shape = (self.shape[0], self.shape[1], end, self.shape[3])
+                self.preview_dirty = True
+                self.updateflg = True
+            return
+        if self.tool != "pen":
+            return
+        if buttons[0]:
+            col = self.drawcol1
+        elif buttons[2]:
+            col = self.drawcol2
+        else:
+            return
+        # 点の間のセルを求める（エディタ部の外も含めて計算する）
+        cells = set()
+        prev = self.pos_to_cell(points[0])
+        for pos in points[1:]:
+            cell = self.pos_to_cell(pos)
+            cells.update(bresenham_line(prev, cell))
+            prev = cell
+        # エディタ部の中のセルだけ書き込む
+        self.sheet.set_pixels([(self.block_rect.left + cellx, self.block_rect.top + celly)
+                               for cellx, celly in cells
+                               if 0 <= cellx < self.editcelx and 0 <= celly < self.editcely],
+                              col)
 
     def update(self):
         """ サブスクリーンの更新 """
         # 更新フラグを建てないために何もしない
 
-    def draw(self):
-        """ エディタ部の描画 """
-        self.screen.fill(COLOR_BLACK)
+    def shape_cells(self):
+        """ ドラッグ中の図形のセルのリスト（エディタ部の外は除く） """
+        tool, start, end, _ = self.shape
+        if tool == "line":
+            cells = bresenham_line(start, end)
+        elif tool == "ellipse":
+            cells = ellipse_points(start, end)
+        else:
+            cells = rect_points(start, end, tool == "fillrect")
+        return [(cellx, celly) for cellx, celly in cells
+                if 0 <= cellx < self.editcelx and 0 <= celly < self.editcely]
+
+    def draw_preview(self):
+        """ 図形のプレビューをoverlayに描いてメイン画面に重ねる\n
+        前のプレビューと今のプレビューを合わせた範囲（overlay上）を返す """
+        old = self.preview_rect
+        if old is not None:
+            self.overlay.fill((0, 0, 0, 0), old)
+        self.preview_rect = None
+        if self.shape is not None:
+            # 表示している範囲のセルだけ描く
+            visible = self.get_visible_rect()
+            cells = [cell for cell in self.shape_cells() if visible.collidepoint(cell)]
+            if cells:
+                col = self.shape[3]
+                if isinstance(col, int):
+                    col = self.sheet.colors[col]    # パレットの番号
+                # セルの枠が見えるように一回り小さく塗る
+                inset = 1 if self.cellsize >= 4 else 0
+                viewrect = Rect(3, 3, self.viewsize[0], self.viewsize[1])
+                self.overlay.set_clip(viewrect)
+                for cellx, celly in cells:
+                    posx, posy = self.cell_to_pos(cellx, celly)
+                    self.overlay.fill(col, (posx + inset, posy + inset,
+                                            self.cellsize - inset * 2,
+                                            self.cellsize - inset * 2))
+                self.overlay.set_clip(None)
+                left = min(cell[0] for cell in cells)
+                top = min(cell[1] for cell in cells)
+                self.preview_rect = Rect(self.cell_to_pos(left, top),
+                                         ((max(cell[0] for cell in cells) - left + 1)
+                                          * self.cellsize,
+                                          (max(cell[1] for cell in cells) - top + 1)
+                                          * self.cellsize)).clip(viewrect)
+        if self.preview_rect is not None:
+            self.mainscreen.blit(self.overlay, self.preview_rect.move(self.rect.topleft),
+                                 self.preview_rect)
+        if old is None:
+            return self.preview_rect
+        if self.preview_rect is None:
+            return old
+        return old.union(self.preview_rect)
+
+    def build_grid(self):
+        """ 表示範囲＋1セル分のセルの枠をgridに描いておく\n
+        gridの(0, 0)はセルの左上で、どのセルの左上に重ねても同じ模様になる
+        （大きさは表示範囲で決まり、ブロックのサイズには依らない）\n
+        拡大率が変わっていなければ何もしない """
+        if self.grid_key == self.cellsize:
+            return
+        self.grid_key = self.cellsize
+        right = (self.viewsize[0] // self.cellsize + 1) * self.cellsize
+        bottom = (self.viewsize[1] // self.cellsize + 1) * self.cellsize
+        # 2色だけのパレットの画面にする（0番が抜き色）
+        self.grid = pygame.Surface((right, bottom), 0, 8)
+        self.grid.set_palette([COLOR_TRANSPARENT, COLOR_GRAY])
+        self.grid.set_colorkey(0)
+        self.grid.fill(0)
+        # セルの枠（セルが小さいときは描かない）
+        if self.cellsize >= 4:
+            for linex in range(0, right, self.cellsize):
+                pygame.draw.line(self.grid, 1, (linex, 0), (linex, bottom - 1))
+                pygame.draw.line(self.grid, 1, (linex + self.cellsize - 1, 0),
+                                 (linex + self.cellsize - 1, bottom - 1))
+            for liney in range(0, bottom, self.cellsize):
+                pygame.draw.line(self.grid, 1, (0, liney), (right - 1, liney))
+                pygame.draw.line(self.grid, 1, (0, liney + self.cellsize - 1),
+                                 (right - 1, liney + self.cellsize - 1))
 
-        # セルの描画
-        for cell in self.cells:
-            pygame.draw.rect(self.screen, cell[0], cell[1])                 # セルの色
-            pygame.draw.rect(self.screen, COLOR_GRAY, cell[1], 1)           # セルの枠
-        # 真ん中に線を引く
-        pygame.draw.line(self.screen, COLOR_BLACK, (self.rect.centerx - self.rect.left, 0),
-                         (self.rect.centerx - self.rect.left, self.rect.bottom), 2)
-        pygame.draw.line(self.screen, COLOR_BLACK, (0, self.rect.centery - self.rect.top),
-                         (self.rect.width, self.rect.centery - self.rect.top), 2)
+    def draw(self):
+        """ エディタ部の描画\n
+        プレビューだけが変わったときは、その範囲だけ描き直してRectを返す """
+        self.preview_dirty, preview_dirty = False, self.preview_dirty
+        if self.dirty_rect is None and preview_dirty and not self.group.allupdate:
+            # 前のプレビューを消して（エディタ部の画面で上書きして）から描き直す
+            if self.preview_rect is not None:
+                self.mainscreen.blit(self.screen, self.preview_rect.move(self.rect.topleft),
+                                     self.preview_rect)
+            rect = self.draw_preview()
+            if rect is None:
+                return Rect(self.rect.topleft, (0, 0))
+            return rect.move(self.rect.topleft)
+        if self.dirty_rect is None:
+            # 他の画面に上書きされた分だけ描き直す
+            self.mainscreen.blit(self.screen, self.rect)
+            self.draw_preview()
+            return None
+        if self.dirty_rect.size == (self.editcelx, self.editcely):
+            self.screen.fill(COLOR_BLACK)
+
+        # 変更された範囲のうち表示している部分だけシートから拡大して描画
+        dirty = self.dirty_rect.clip(self.get_visible_rect())
+        self.dirty_rect = None
+        self.screen.set_clip(Rect(3, 3, self.viewsize[0], self.viewsize[1]))
+        if dirty.width and dirty.height:
+            blocksurface = self.sheet.surface.subsurface(self.block_rect)
+            left, top = self.cell_to_pos(dirty.left, dirty.top)
+            right, bottom = self.cell_to_pos(dirty.right, dirty.bottom)
+            self.screen.blit(pygame.transform.scale(blocksurface.subsurface(dirty),
+                                                    (right - left, bottom - top)),
+                             (left, top))
+            # セルの枠を重ねる
+            self.build_grid()
+            self.screen.blit(self.grid, (left, top), Rect(0, 0, right - left, bottom - top))
+            # 真ん中の線
+            centerx, centery = self.cell_to_pos(self.editcelx // 2, self.editcely // 2)
+            blockleft, blocktop = self.cell_to_pos(0, 0)
+            blockright, blockbottom = self.cell_to_pos(self.editcelx, self.editcely)
+            self.screen.set_clip(self.screen.get_clip().clip(
+                Rect(left, top, right - left, bottom - top)))
+            pygame.draw.line(self.screen, COLOR_BLACK, (centerx, blocktop),
+                             (centerx, blockbottom), 2)
+            pygame.draw.line(self.screen, COLOR_BLACK, (blockleft, centery),
+                             (blockright, centery), 2)
+        self.screen.set_clip(None)
 
         # エディタ部をメイン画面に描画
         self.mainscreen.blit(self.screen, self.rect)
+        self.draw_preview()
+        return None
 
     def cells_clear(self):
         """ 全セルのクリア """
-        self.cells.clear()
-        # 全セルのRectと色（白）を設定
-        for i in range(self.editcelx):
-            for j in range(self.editcely):
-                cellrect = Rect(i * self.cellsize +3, j * self.cellsize + 3,
-                                self.cellsize, self.cellsize)
-                self.cells.append([COLOR_WHITE, cellrect])
-        self.updateflg = True
+        # 全セルを消す（一番下のレイヤーは白）
+        self.sheet.clear(self.block_rect)
 
 class ViewScreen(SubScreen):
     """ 全体の画像を表示する画面 """
-    def __init__(self, name, rect, mainscreen):
+    def __init__(self, name, rect, mainscreen, sheet):
         super().__init__(name, rect, mainscreen)
-        self.editcelx = 32              # エディタ画面のサイズ（32 x 32
-        self.editcely = 32
-        self.blockx = 5                 # エディタ画面何個分か
-        self.blocky = 5
-        self.cellsize = 3               # 1個のセルのサイズ
+        self.sheet = sheet              # 表示するシート
+        self.editcelx = sheet.editcelx  # エディタ画面のサイズ（32 x 32
+        self.editcely = sheet.editcely
+        self.blockx = sheet.blockx      # エディタ画面何個分か
+        self.blocky = sheet.blocky
+        self.blockwidth = (rect.width - 6) // self.blockx    # 1ブロックの表示サイズ
+        self.blockheight = (rect.height - 6) // self.blocky  #   （5 x 5 のときは96）
         self.blocks = []                # １ブロック情報のリスト
-                                        # １ブロックは (color, rect)
+                                        # １ブロックは (rect, シート上のrect)
+                                        #   描画はシートのSurfaceの一部をそのまま縮小する
+        self.dirty_blocks = set()       # 描画し直すブロックの番号
         self.select_block = 0           # 選択中のブロック
         self.save_dir = os.path.dirname(__file__) + "/pictures/" # 保存場所
         self.save_filename = "newfile.png"   # 保存ファイル名
-        self.blocks_clear()
+        self.worker = ThreadPoolExecutor(max_workers=1)  # 保存、読み込みをするスレッド
+        self.status = ""                # 保存、読み込みの状況（タイトルに表示する）
+        self.autosave = AutoSave(os.path.dirname(__file__) + "/autosave/", sheet,
+                                 self.autosave_document)
+                                        # 自動保存
+        self.project = None             # 開いているプロジェクトファイル（ProjectFile）
+                                        #   置き換えと読み込みは別スレッドでだけ行う
+        self.sheet_count = 0            # プロジェクトのシート数（0のときはpngを編集中）
+        self.sheet_index = 0            # 編集中のシートの番号
+        self.next_sheet = 0             # 切り替え先のシートの番号（展開中はsheet_indexと違う）
+        self.sheet_edits = {}           # 保存していないシートの変更
+                                        #   {シートの番号: {ブロックの番号: 圧縮したブロック}}
+                                        #   別スレッドから読むので、シートごとの辞書は
+                                        #   書き換えずに作り直す
+        self.changed_blocks = set()     # 編集中のシートでsheet_editsに入れていない変更のブロック
+
+        self.screen.fill(COLOR_BLACK)
+        for i in range(self.blockx * self.blocky):
+            sheetrect = sheet.get_block_rect(i)
+            blockrect = Rect(i // self.blocky * self.blockwidth + 3,
+                             i % self.blocky * self.blockheight + 3,
+                             self.blockwidth, self.blockheight)
+            self.blocks.append((blockrect, sheetrect))
+        self.dirty_blocks.update(range(len(self.blocks)))
+        self.updateflg = True
+        sheet.add_listener(self.sheet_changed)
+
+    def sheet_changed(self, rect):
+        """ シートの変更通知 変更範囲に掛かるブロックだけ描画し直す """
+        blocks = self.sheet.get_blocks_in_rect(rect)
+        self.dirty_blocks.update(blocks)
+        self.changed_blocks.update(blocks)
+        self.updateflg = True
 
     def mouse_button_down(self, pos, button):
         """ ボタンが押されたときの処理 """
         if button == BUTTON_LEFT:
             for i, block in enumerate(self.blocks):
                 if block[0].collidepoint(pos):
+                    # 選択枠を描き直すため、前後のブロックを更新
+                    self.dirty_blocks.add(self.select_block)
+                    self.dirty_blocks.add(i)
                     self.select_block = i
                     self.updateflg = True
 
@@ -349,54 +1832,53 @@ class ViewScreen(SubScreen):
 
     def draw(self):
         """ 全体の画像を表示する画面の描画 """
-        self.screen.fill(COLOR_BLACK)
-
-        # セルの描画
-        for block in self.blocks:
-            # ブロック内のセルの描画
-            for cell in block[1]:
-                pygame.draw.rect(self.screen, cell[0], cell[1])             # セルの色
-
-            pygame.draw.rect(self.screen, COLOR_GRAY, block[0], 1)          # ブロックの枠
-
-        pygame.draw.rect(self.screen, COLOR_BLACK,
-                         self.blocks[self.select_block][0], 3)
+        # 変更のあったブロックだけ縮小画像を作り直す
+        for i in sorted(self.dirty_blocks):
+            blockrect, sheetrect = self.blocks[i]
+            self.screen.blit(pygame.transform.scale(self.sheet.surface.subsurface(sheetrect),
+                                                    blockrect.size), blockrect)
+            if i == self.select_block:
+                pygame.draw.rect(self.screen, COLOR_BLACK, blockrect, 3)    # 選択中の枠
+            else:
+                pygame.draw.rect(self.screen, COLOR_GRAY, blockrect, 1)     # ブロックの枠
+        self.dirty_blocks.clear()
 
         # 全体の画像を表示する画面をメイン画面に描画
         self.mainscreen.blit(self.screen, self.rect)
 
     def blocks_clear(self):
         """ ブロックのクリア """
-        self.blocks.clear()
-        cells = []
-        for i in range(self.blockx):
-            for j in range(self.blocky):
-                blockrect = Rect(i * self.cellsize * self.editcelx + 3,
-                                 j * self.cellsize * self.editcely + 3,
-                                 self.cellsize * self.editcelx, self.cellsize * self.editcely)
-                cells.clear()
-                # 全セルのRectと色（白）を設定
-                for k in range(self.editcelx):
-                    for l in range(self.editcely):
-                        cellrect = Rect(k * self.cellsize + blockrect.left,
-                                        l * self.cellsize + blockrect.top,
-                                        self.cellsize, self.cellsize)
-                        cells.append([COLOR_WHITE, cellrect])
-
-                self.blocks.append([blockrect, list(cells)])
+        self.sheet.clear()
 
     def load(self):
-        """ 画像ファイルを読み込む """
-        msgs = []               # メッセージ用
-
-        # 保存ファイル名入力
-        msgs.append("load filename?")
-        msgbox = MsgBox(MSGBOX_TYPE_INPUT, msgs, self.mainscreen,
-                        os.path.splitext(self.save_filename)[0])
-        if not msgbox.return_value:
+        """ 画像ファイルを読み込む（読み込みブラウザでファイルを選んでから読み込む） """
+        browser = self.group.get_subscreen("LoadBrowser")
+        browser.open(self.save_dir, self.load_selected)
+        self.group.open_modal(browser)
+
+    def load_selected(self, filename):
+        """ 読み込みブラウザが閉じたときの処理\n
+        filenameがNoneのときはファイル名を入力してから読み込む """
+        if filename is None:
+            # 保存ファイル名入力
+            self.group.open_msgbox(MSGBOX_TYPE_INPUT, ["load filename?"], self.load_file,
+                                   self.input_name())
+        else:
+            self.load_file(filename)
+
+    def input_name(self):
+        """ ファイル名入力の初期値（pngのときは拡張子を省く） """
+        if self.save_filename.endswith(PROJECT_EXT):
+            return self.save_filename
+        return os.path.splitext(self.save_filename)[0]
+
+    def load_file(self, filename):
+        """ 入力されたファイル名の画像ファイルを読み込む\n
+        拡張子が.dotpのときはプロジェクトファイルを開く """
+        if not filename:
             return
         else:
-            self.save_filename = msgbox.return_value + ".png"
+            self.save_filename = filename if filename.endswith(PROJECT_EXT) else filename + ".png"
 
         # 保存フォルダの存在を確認
         if not os.path.isdir(self.save_dir):
@@ -405,30 +1887,25 @@ class ViewScreen(SubScreen):
         if not os.path.isfile(self.save_dir + self.save_filename):
             return
 
-        loadscreen = pygame.image.load(self.save_dir + self.save_filename).convert()
-
-        self.blocks_clear()
-
-        for i, block in enumerate(self.blocks):
-            for j, cell in enumerate(block[1]):
-                cell[0] = loadscreen.get_at((j // self.editcelx + self.editcelx * (i // self.blockx),
-                                             j % self.editcely + self.editcely * (i % self.blocky)))
-
-                self.select_block = 0
-                self.updateflg = True
+        # 読み込みは別スレッドで行い、終わったらfile_event()でシートを置き換える
+        self.status = " (load 0%)"
+        if self.save_filename.endswith(PROJECT_EXT):
+            self.worker.submit(self.open_project_in_background, self.save_dir + self.save_filename)
+        else:
+            self.worker.submit(self.load_in_background, self.save_dir + self.save_filename)
 
     def save(self):
-        """ 画像ファイルに保存する """
-        msgs = []               # メッセージ用
-
+        """ 画像ファイルに保存する（ファイル名を入力してから保存する） """
         # 保存ファイル名入力
-        msgs.append("save filename?")
-        msgbox = MsgBox(MSGBOX_TYPE_INPUT, msgs, self.mainscreen,
-                        os.path.splitext(self.save_filename)[0])
-        if not msgbox.return_value:
+        self.group.open_msgbox(MSGBOX_TYPE_INPUT, ["save filename?"], self.save_filename_entered,
+                               self.input_name())
+
+    def save_filename_entered(self, filename):
+        """ ファイル名が入力されたときの処理 """
+        if not filename:
             return
         else:
-            self.save_filename = msgbox.return_value + ".png"
+            self.save_filename = filename if filename.endswith(PROJECT_EXT) else filename + ".png"
 
         # 保存フォルダの存在を確認
         if not os.path.isdir(self.save_dir):
@@ -437,60 +1914,322 @@ class ViewScreen(SubScreen):
         # 保存ファイルの存在確認
         if os.path.isfile(self.save_dir + self.save_filename):
             # 上書き確認
-            msgs.clear()
-            msgs.append("overwrite " + self.save_filename + "?")
-            msgbox = MsgBox(MSGBOX_TYPE_YESNO, msgs, self.mainscreen)
-            if not msgbox.return_value:
-                return
+            self.group.open_msgbox(MSGBOX_TYPE_YESNO,
+                                   ["overwrite " + self.save_filename + "?"], self.save_file)
+            return
+        self.save_file(True)
+
+    def save_file(self, answer):
+        """ 画像ファイルに書き込む answerがFalseのときは何もしない """
+        if not answer:
+            return
 
-        savescreen = pygame.Surface((self.editcelx * self.blockx,
-                                     self.editcely * self.blocky))
-        # save用画面にblock情報を描画する
-        for i, block in enumerate(self.blocks):
-            for j, cell in enumerate(block[1]):
-                # x座標の計算
-                posx = i // self.blockx * self.editcelx + j // self.editcelx
-                # y座標の計算
-                posy = i % self.blocky * self.editcely + j % self.editcely
-                savescreen.fill(cell[0], Rect(posx, posy, 1, 1))
-
-        # save
-        pygame.image.save(savescreen, self.save_dir + self.save_filename)
-
-        # メッセージボックスを表示
-        msgs.clear()
-        msgs.append("Saved " + self.save_filename)
-        MsgBox(MSGBOX_TYPE_OK, msgs, self.mainscreen)
+        # 今のシートをコピーして、書き込みは別スレッドで行う
+        self.status = " (save 0%)"
+        if self.save_filename.endswith(PROJECT_EXT):
+            # pngを編集中のときは今のシートだけのプロジェクトにする
+            if self.sheet_count == 0:
+                self.sheet_count = 1
+                self.sheet_index = self.next_sheet = 0
+                self.changed_blocks.update(range(self.blockx * self.blocky))
+            self.stash_sheet()
+            self.worker.submit(self.save_project_in_background, dict(self.sheet_edits),
+                               self.sheet_count, self.save_dir + self.save_filename)
+        else:
+            self.worker.submit(self.save_in_background, self.sheet.snapshot(),
+                               self.save_dir + self.save_filename)
+
+    def save_in_background(self, snapshot, filename):
+        """ 画像ファイルへの書き込み（別スレッドで実行される） """
+        try:
+            post_file_event("save", "progress", filename, progress=50)
+            self.sheet.save_snapshot(snapshot, filename)
+        except (pygame.error, OSError) as error:
+            post_file_event("save", "error", filename, error=str(error))
+        else:
+            post_file_event("save", "done", filename)
+
+    def load_in_background(self, filename):
+        """ 画像ファイルの読み込みと変換（別スレッドで実行される） """
+        try:
+            data = self.sheet.decode(filename,
+                                     lambda percent: post_file_event("load", "progress", filename,
+                                                                     progress=percent))
+        except (pygame.error, OSError) as error:
+            post_file_event("load", "error", filename, error=str(error))
+        else:
+            post_file_event("load", "done", filename, data=data)
+
+    def stash_sheet(self):
+        """ 編集中のシートの変更されたブロックを圧縮してsheet_editsに入れる """
+        if not self.changed_blocks:
+            return
+        sheet = self.sheet
+        edits = dict(self.sheet_edits.get(self.sheet_index, {}))
+        for block in self.changed_blocks:
+            edits[block] = zlib.compress(get_block_bytes(sheet.pixels, sheet.width, sheet.bpp,
+                                                         sheet.get_block_rect(block)), 1)
+        self.sheet_edits[self.sheet_index] = edits
+        self.changed_blocks.clear()
+
+    def select_sheet(self, offset):
+        """ プロジェクトのシートをoffsetだけ前(-)、後(+)に切り替える\n
+        最後のシートの次は白いシートを追加する\n
+        切り替え先のシートは別スレッドで展開し、終わったらfile_event()で置き換える """
+        if self.sheet_count == 0:
+            return
+        index = min(max(self.next_sheet + offset, 0), self.sheet_count)
+        if index == self.next_sheet:
+            return
+        if index == self.sheet_count:
+            self.sheet_count += 1
+        self.stash_sheet()
+        self.next_sheet = index
+        self.status = " (load 0%)"
+        self.worker.submit(self.load_sheet_in_background, index,
+                           self.save_dir + self.save_filename)
+
+    def title(self):
+        """ タイトルに表示するファイル名、シートの番号、保存、読み込みの状況 """
+        if self.sheet_count:
+            return f"{self.save_filename} [{self.sheet_index + 1}/{self.sheet_count}]{self.status}"
+        return self.save_filename + self.status
+
+    def read_project_block(self, index, block):
+        """ プロジェクトファイルのブロックを展開する（別スレッドで実行される）\n
+        パレットの番号で持っていて、違うパレットで保存したブロックは今のパレットの番号に変換する """
+        sheet = self.sheet
+        data = self.project.read_block(index, block)
+        if sheet.indexed and self.project.colors != [tuple(col) for col in sheet.colors]:
+            data = quantize(indices_to_rgb(data, self.project.colors), sheet.editcelx,
+                            sheet.colors)
+        return data
+
+    def read_sheet(self, index, edits):
+        """ プロジェクトのindex番目のシートを展開して、シート全体のバイト列を返す
+        （別スレッドで実行される）\n
+        editsにあるブロックは保存していない変更から、無いブロックはプロジェクトファイルから、
+        どちらにも無いブロックは白にする """
+        sheet = self.sheet
+        pixels = bytearray(sheet.encode(COLOR_WHITE)) * (sheet.width * sheet.height)
+        for block in range(sheet.blockx * sheet.blocky):
+            if block in edits:
+                data = zlib.decompress(edits[block])
+            elif self.project is not None and index < len(self.project.sheets):
+                data = self.read_project_block(index, block)
+            else:
+                continue
+            set_block_bytes(pixels, sheet.width, sheet.bpp, sheet.get_block_rect(block), data)
+        return pixels
+
+    def open_project_in_background(self, filename):
+        """ プロジェクトファイルを開いて最初のシートを展開する（別スレッドで実行される）\n
+        開くときは索引だけを読み、他のシートは切り替えたときに展開する """
+        try:
+            project = ProjectFile(filename)
+            try:
+                project.check(self.sheet)
+            except ValueError:
+                project.close()
+                raise
+            post_file_event("load", "progress", filename, progress=50)
+            self.close_project()
+            self.project = project
+            data = self.read_sheet(0, {})
+        except (OSError, ValueError, zlib.error) as error:
+            post_file_event("load", "error", filename, error=str(error))
+        else:
+            post_file_event("load", "done", filename, data=data, sheet=0,
+                            count=len(project.sheets))
+
+    def load_sheet_in_background(self, index, filename):
+        """ プロジェクトのシートの展開（別スレッドで実行される） """
+        try:
+            data = self.read_sheet(index, self.sheet_edits.get(index, {}))
+        except (OSError, ValueError, zlib.error) as error:
+            post_file_event("load", "error", filename, error=str(error))
+        else:
+            post_file_event("load", "done", filename, data=data, sheet=index)
+
+    def save_project_in_background(self, edits, count, filename):
+        """ プロジェクトファイルへの書き込み（別スレッドで実行される）\n
+        変更の無いブロックは開いているプロジェクトファイルから圧縮したまま写す """
+        sheet = self.sheet
+        project = self.project
+        colors = [tuple(col) for col in sheet.colors]
+        try:
+            white = zlib.compress(sheet.encode(COLOR_WHITE) * (sheet.editcelx * sheet.editcely), 1)
+            sheets = []
+            for index in range(count):
+                blocks = edits.get(index, {})
+                inproject = project is not None and index < len(project.sheets)
+                name, meta = project.sheets[index][:2] if inproject else (f"sheet{index:03d}", {})
+                chunks = []
+                for block in range(sheet.blockx * sheet.blocky):
+                    if block in blocks:
+                        chunks.append(blocks[block])
+                    elif not inproject:
+                        chunks.append(white)
+                    elif not sheet.indexed or project.colors == colors:
+                        chunks.append(project.read_chunk(index, block))
+                    else:
+                        chunks.append(zlib.compress(self.read_project_block(index, block), 1))
+                sheets.append((name, meta, chunks))
+            post_file_event("save", "progress", filename, progress=50)
+            write_project(filename + ".tmp",
+                          (sheet.editcelx, sheet.editcely, sheet.blockx, sheet.blocky),
+                          sheet.bpp, colors, sheets)
+            self.replace_project(filename + ".tmp", filename)
+        except (OSError, ValueError, zlib.error) as error:
+            post_file_event("save", "error", filename, error=str(error))
+        else:
+            post_file_event("save", "done", filename, edits=edits)
+
+    def replace_project(self, tempname, filename):
+        """ 書き込んだ一時ファイルでプロジェクトファイルを置き換えて開き直す
+        （別スレッドで実行される）\n
+        開いたままのファイルは置き換えられないOSがあるので先に閉じる
+        （置き換えに失敗したときは元のファイルを開き直す） """
+        reopen = self.project.filename if self.project is not None else None
+        self.close_project()
+        try:
+            os.replace(tempname, filename)
+            reopen = filename
+        finally:
+            if reopen is not None:
+                self.project = ProjectFile(reopen)
+
+    def close_project(self):
+        """ 開いているプロジェクトファイルを閉じる（別スレッドで実行される） """
+        if self.project is not None:
+            self.project.close()
+            self.project = None
+
+    def autosave_document(self):
+        """ 自動保存に記録するドキュメントの情報と、保存していない他のシートの変更 """
+        return ({"filename": self.save_filename, "sheet": self.sheet_index,
+                 "count": self.sheet_count}, self.sheet_edits)
+
+    def restore_autosave(self, answer):
+        """ 自動保存を始める answerがTrueのときは落ちたエディタの記録を復元する\n
+        復元したときはファイル名とプロジェクトのシートの変更も戻し、
+        プロジェクトファイルは別スレッドで開き直す """
+        restored = self.autosave.start(answer)
+        if restored is None:
+            return
+        info, edits = restored
+        self.save_filename = info["filename"] or self.save_filename
+        self.sheet_count = info["count"]
+        self.sheet_index = self.next_sheet = info["sheet"]
+        self.sheet_edits = edits
+        if self.sheet_count and self.save_filename.endswith(PROJECT_EXT):
+            self.worker.submit(self.reopen_project, self.save_dir + self.save_filename)
+
+    def reopen_project(self, filename):
+        """ 自動保存から復元したプロジェクトのファイルを開き直す（別スレッドで実行される）\n
+        開けないときは変更の無いブロックは白になる """
+        try:
+            project = ProjectFile(filename)
+            try:
+                project.check(self.sheet)
+            except ValueError:
+                project.close()
+                raise
+        except (OSError, ValueError) as error:
+            post_file_event("load", "error", filename, error=str(error))
+        else:
+            self.close_project()
+            self.project = project
+
+    def file_event(self, event):
+        """ 保存、読み込みの状況が届いたときの処理\n
+        読み込みが終わったときはシートを置き換える """
+        if event.state == "progress":
+            self.status = f" ({event.file_type} {event.progress}%)"
+            return
+        self.status = ""
+        if event.state == "error":
+            # 切り替えられなかったシートは選び直せるようにする
+            self.next_sheet = self.sheet_index
+        if event.state == "done" and event.file_type == "load":
+            sheet_index = getattr(event, "sheet", None)
+            if sheet_index is None or hasattr(event, "count"):
+                # 別のファイルを開いたときは保存していないシートの変更も捨てる
+                self.select_block = 0
+                self.sheet_edits = {}
+                self.sheet_count = getattr(event, "count", 0)
+                self.next_sheet = sheet_index or 0
+                if sheet_index is None:
+                    self.worker.submit(self.close_project)
+            else:
+                # 切り替える前のシートの変更を残しておく
+                self.stash_sheet()
+            self.sheet_index = sheet_index or 0
+            self.sheet.set_data(event.data)
+            self.changed_blocks.clear()
+            if sheet_index is None or hasattr(event, "count"):
+                # 読み込んだファイルと同じなので自動保存の記録は消す
+                # （シートの切り替えのときは、前のシートの変更を記録したまま残す）
+                self.autosave.reset()
+        if event.state == "done" and getattr(event, "edits", None) is not None:
+            # 保存した変更は消す（保存中にまた変更したシートは残す）
+            for index, blocks in event.edits.items():
+                if self.sheet_edits.get(index) is blocks:
+                    del self.sheet_edits[index]
+        if event.state == "done" and event.file_type == "save":
+            # 保存したファイルと同じなので自動保存の記録は書き直す
+            # （保存中の変更と、保存していない他のシートの変更は次の記録で書く）
+            self.autosave.reset(False)
+        # 他のメッセージボックスを表示中のときはタイトルにだけ表示する
+        if self.group.modal is not None:
+            if event.state == "error":
+                self.status = f" ({event.file_type} error)"
+        elif event.state == "error":
+            self.group.open_msgbox(MSGBOX_TYPE_OK, [event.file_type + " error",
+                                                    event.error[:20]])
+        elif event.file_type == "save":
+            # メッセージボックスを表示
+            self.group.open_msgbox(MSGBOX_TYPE_OK,
+                                   ["Saved " + os.path.basename(event.filename)])
 
 class PalettScreen(SubScreen):
     """ パレットの画面 """
     def __init__(self, name, rect, mainscreen):
         super().__init__(name, rect, mainscreen)
-        self.font = pygame.font.SysFont(None, 20)
+        self.fontsize = 20
         self.editcelx = 15
         self.editcely = 2
         self.cellsize = 20              # 1個のセルのサイズ
         self.drawcol1 = COLOR_BLACK     # クリックした場所に塗る色１
         self.drawcol2 = COLOR_WHITE     # クリックした場所に塗る色２
+        self.drawindex1 = None          # 色１のパレットの番号（パレットから選ぶまではNone）
+        self.drawindex2 = None          # 色２のパレットの番号
         self.cells = []                 # 色情報のリスト
                                         # 1マスは (color, rect)
 
     def mouse_button_down(self, pos, button):
         """ ボタンが押されたときの処理 """
-        for cell in self.cells:
+        for i, cell in enumerate(self.cells):
             # ボタンが押されたセルの色を変更
             if cell[1].collidepoint(pos):
                 if button == BUTTON_LEFT:
                     self.drawcol1 = cell[0]
+                    self.drawindex1 = i
                 elif button == BUTTON_RIGHT:
                     self.drawcol2 = cell[0]
+                    self.drawindex2 = i
+                self.updateflg = True
+
+    def update(self):
+        """ サブスクリーンの更新 """
+        # 色が選ばれたときだけ更新するので何もしない
 
     def draw(self):
         """ パレット画面の描画 """
         self.screen.fill(COLOR_GRAY)
 
         # 選択中の色表示
-        self.screen.blit(self.font.render(" left      right", True, COLOR_BLACK), (15, 5))
+        self.screen.blit(render_text(" left      right", self.fontsize, COLOR_BLACK), (15, 5))
         pygame.draw.rect(self.screen, self.drawcol1, (10, 20, 42, 42))
         pygame.draw.rect(self.screen, self.drawcol2, (55, 20, 42, 42))
 
@@ -514,12 +2253,18 @@ class PalettScreen(SubScreen):
                             20 + (i // self.editcelx) * (self.cellsize + 2),
                             self.cellsize, self.cellsize)
             self.cells.append([col[1], cellrect])
+        # 選択中の色も新しいパレットの色にする
+        if self.drawindex1 is not None:
+            self.drawcol1 = self.cells[self.drawindex1][0]
+        if self.drawindex2 is not None:
+            self.drawcol2 = self.cells[self.drawindex2][0]
+        self.updateflg = True
 
 class PalettSettingScreen(SubScreen):
     """ パレット設定の画面 """
     def __init__(self, name, rect, mainscreen):
         super().__init__(name, rect, mainscreen)
-        self.font = pygame.font.SysFont(None, 30)
+        self.fontsize = 30
         self.rect.center = WINDOW_RECT.center       # メイン画面中央に配置
         self.color_table = []           # カラーテーブル用
         self.color_table_size = 30
@@ -529,6 +2274,7 @@ class PalettSettingScreen(SubScreen):
         self.palett = []                # 色情報のリスト
         self.cells = []                 # ボタン
         self.select_color = 0           # 選択中の色
+        self.closing = False            # 閉じるイベントを発行したか？（それからはクリックを無視する）
         self.screenlevel = 1
         self.visible = False
 
@@ -556,10 +2302,14 @@ class PalettSettingScreen(SubScreen):
 
     def mouse_button_down(self, pos, button):
         """ マウスが押されたときの処理 """
+        if self.closing:
+            return
         if button == BUTTON_LEFT:
             # ボタンが押されたら項目のイベントを発行
             for cell in self.cells:
                 if cell[1].collidepoint(pos):
+                    if cell[0] in ("O K", "CANCEL"):
+                        self.closing = True
                     if cell[0] == "O K":
                         userevent = pygame.event.Event(USEREVENT_PALETTSETTING,
                                                        {"palettset_type": "palettset_" + cell[0]})
@@ -592,14 +2342,11 @@ class PalettSettingScreen(SubScreen):
                 pygame.draw.rect(self.screen, COLOR_BLACK, cell[1], 3)          # セルの枠
                 # RBG値を表示
                 tempstr = "R:" + str(cell[0][0])
-                self.screen.blit(self.font.render(tempstr,
-                                                  True, COLOR_BLACK), (20, 20))
+                self.screen.blit(render_text(tempstr, self.fontsize, COLOR_BLACK), (20, 20))
                 tempstr = ", G:" + str(cell[0][1])
-                self.screen.blit(self.font.render(tempstr,
-                                                  True, COLOR_BLACK), (85, 20))
+                self.screen.blit(render_text(tempstr, self.fontsize, COLOR_BLACK), (85, 20))
                 tempstr = ", B:" + str(cell[0][2])
-                self.screen.blit(self.font.render(tempstr,
-                                                  True, COLOR_BLACK), (160, 20))
+                self.screen.blit(render_text(tempstr, self.fontsize, COLOR_BLACK), (160, 20))
 
         # パレットの表示
         for cell in self.palett:
@@ -613,7 +2360,7 @@ class PalettSettingScreen(SubScreen):
         for cell in self.cells:
             pygame.draw.rect(self.screen, COLOR_SILVER, cell[1])
             pygame.draw.rect(self.screen, COLOR_BLACK, cell[1], 1)
-            self.screen.blit(self.font.render(cell[0], True, COLOR_BLACK),  # ボタン名
+            self.screen.blit(render_text(cell[0], self.fontsize, COLOR_BLACK),  # ボタン名
                              (cell[1].left + 8, cell[1].top + 10))
             # マウスカーソルが項目上にある場合は、枠を描画する
             posx, posy = pygame.mouse.get_pos()
@@ -645,21 +2392,35 @@ class PalettSettingScreen(SubScreen):
 
         return retpalett
 
-class MsgBox():
-    """ メッセージ表示用画面 画面中央にメッセージを表示する画面
-        この画面は個別に呼び出される """
-    def __init__(self, msgbox_type, msgs, mainscreen, value=None):
-        self.mainscreen = mainscreen
-        self.rect = Rect(0, 0, 300, 150)
+class MsgBox(SubScreen):
+    """ メッセージ表示用画面 画面中央にメッセージを表示する画面\n
+    SubScreenGroup.open_msgbox()で表示し、閉じるとUSEREVENT_MSGBOXを発行する
+    （他の画面はロックされる） """
+    def __init__(self, name, rect, mainscreen):
+        super().__init__(name, rect, mainscreen)
         self.rect.center = WINDOW_RECT.center       # メッセージボックスはメイン画面中央に配置
-        self.screen = pygame.Surface(self.rect.size)# サブスクリーンのSurfaceオブジェクト
-        self.font = pygame.font.SysFont(None, 30)
-        self.msgs = msgs
+        self.fontsize = 30
+        self.msgs = []
         self.cells = []                             # ボタンのリスト
-        self.msgbox_type = msgbox_type              # メッセージボックスのタイプ
-        self.return_value = value                   # メッセージボックスの戻り値
+        self.msgbox_type = MSGBOX_TYPE_OK           # メッセージボックスのタイプ
+        self.return_value = None                    # メッセージボックスの戻り値
+        self.callback = None                        # 閉じたときにreturn_valueを渡して呼ぶ関数
+        self.closing = False                        # 閉じるイベントを発行したか？
+                                                    #   （それからはクリックとキーを無視する）
+        self.screenlevel = 2
+        self.visible = False
+
+    def open(self, msgbox_type, msgs, callback=None, value=None):
+        """ メッセージボックスの内容を設定する\n
+        valueは戻り値の初期値（インプットボックスの入力値） """
+        self.msgs = msgs
+        self.msgbox_type = msgbox_type
+        self.return_value = value
+        self.callback = callback
+        self.closing = False
 
         # メッセージボックスの要素の追加
+        self.cells.clear()
         if self.msgbox_type == MSGBOX_TYPE_OK:
             self.cells.append(["O K", Rect(122, 100, 55, 40)])
         elif self.msgbox_type == MSGBOX_TYPE_YESNO:
@@ -670,56 +2431,59 @@ class MsgBox():
             self.cells.append(["O K", Rect(30, 100, 100, 40)])
             self.cells.append(["CANCEL", Rect(160, 100, 100, 40)])
 
-        # ループ
-        while True:
-            self.draw()
-            event = pygame.event.poll()
-            if event.type == MOUSEBUTTONDOWN:
-                for cell in self.cells:
-                    if cell[1].collidepoint(event.pos[0] - self.rect.left,
-                                            event.pos[1] - self.rect.top):
-                        if cell[0] == "O K" and self.msgbox_type == MSGBOX_TYPE_OK:
-                            userevent = pygame.event.Event(USEREVENT_ALLUPDATE)
-                            pygame.event.post(userevent)
-                            return
-                        elif cell[0] == "YES":
-                            self.return_value = True
-                            userevent = pygame.event.Event(USEREVENT_ALLUPDATE)
-                            pygame.event.post(userevent)
-                            return
-                        elif cell[0] == "N O":
-                            self.return_value = False
-                            userevent = pygame.event.Event(USEREVENT_ALLUPDATE)
-                            pygame.event.post(userevent)
-                            return
-                        elif cell[0] == "O K" and self.msgbox_type == MSGBOX_TYPE_INPUT:
-                            userevent = pygame.event.Event(USEREVENT_ALLUPDATE)
-                            pygame.event.post(userevent)
-                            return
-                        elif cell[0] == "CANCEL":
-                            self.return_value = False
-                            userevent = pygame.event.Event(USEREVENT_ALLUPDATE)
-                            pygame.event.post(userevent)
-                            return
-            # インプットボックスのときのみキー入力受付
-            elif event.type == KEYDOWN and self.msgbox_type == MSGBOX_TYPE_INPUT:
-                if event.key == K_BACKSPACE:            # バックスペース
-                    self.return_value = self.return_value[0:-1]
-                elif K_0 <= event.key <= K_9:           # 数字
-                    self.return_value = self.return_value + pygame.key.name(event.key)
-                elif K_KP0 <= event.key <= K_KP9:       # テンキー
-                    self.return_value = self.return_value + pygame.key.name(event.key)[1]
-                elif K_a <= event.key <= K_z:           # アルファベット
-                    if event.mod & KMOD_SHIFT:          # シフト＋で大文字
-                        self.return_value = self.return_value +\
-                            str.upper(pygame.key.name(event.key))
-                    else:                               # 小文字
-                        self.return_value = self.return_value + pygame.key.name(event.key)
-                elif event.key == K_BACKSLASH:         # シフト＋バックスラッシュ＝アンダーバー
-                    if event.mod & KMOD_SHIFT:
-                        self.return_value = self.return_value + pygame.key.name(K_UNDERSCORE)
-
-            pygame.display.update()
+    def close(self, cancel=False):
+        """ 戻り値を付けてUSEREVENT_MSGBOXを発行する（2回目からは何もしない）\n
+        cancelのときは戻り値をFalseにする（入力値は閉じるまで描画するので書き換えない） """
+        if self.closing:
+            return
+        self.closing = True
+        userevent = pygame.event.Event(USEREVENT_MSGBOX,
+                                       {"msgbox_type": self.msgbox_type,
+                                        "value": False if cancel else self.return_value,
+                                        "callback": self.callback,
+                                        "screen": self})
+        pygame.event.post(userevent)
+
+    def mouse_button_down(self, pos, button):
+        """ ボタンが押されたときの処理 """
+        if self.closing:
+            return
+        for cell in self.cells:
+            if cell[1].collidepoint(pos):
+                if cell[0] == "O K" and self.msgbox_type == MSGBOX_TYPE_OK:
+                    self.close()
+                elif cell[0] == "YES":
+                    self.return_value = True
+                    self.close()
+                elif cell[0] == "N O":
+                    self.return_value = False
+                    self.close()
+                elif cell[0] == "O K" and self.msgbox_type == MSGBOX_TYPE_INPUT:
+                    self.close()
+                elif cell[0] == "CANCEL":
+                    self.close(cancel=True)
+
+    def key_down(self, key, mod):
+        """ キーが押されたときの処理\n
+        インプットボックスのときのみキー入力受付 """
+        if self.msgbox_type != MSGBOX_TYPE_INPUT or self.closing:
+            return
+        if key == K_BACKSPACE:                  # バックスペース
+            self.return_value = self.return_value[0:-1]
+        elif K_0 <= key <= K_9:                 # 数字
+            self.return_value = self.return_value + pygame.key.name(key)
+        elif K_KP0 <= key <= K_KP9:             # テンキー
+            self.return_value = self.return_value + pygame.key.name(key)[1]
+        elif K_a <= key <= K_z:                 # アルファベット
+            if mod & KMOD_SHIFT:                # シフト＋で大文字
+                self.return_value = self.return_value + str.upper(pygame.key.name(key))
+            else:                               # 小文字
+                self.return_value = self.return_value + pygame.key.name(key)
+        elif key == K_BACKSLASH:                # シフト＋バックスラッシュ＝アンダーバー
+            if mod & KMOD_SHIFT:
+                self.return_value = self.return_value + pygame.key.name(K_UNDERSCORE)
+        elif key in (K_PERIOD, K_KP_PERIOD):    # ピリオド（プロジェクトファイルの拡張子用）
+            self.return_value = self.return_value + "."
 
     def draw(self):
         """ メッセージ画面の描画 """
@@ -727,7 +2491,7 @@ class MsgBox():
 
         # メッセージの表示
         for i, msg in enumerate(self.msgs):
-            self.screen.blit(self.font.render(msg, True, COLOR_BLACK),  # ボタン名
+            self.screen.blit(render_text(msg, self.fontsize, COLOR_BLACK),  # ボタン名
                              (30, i * 20 + 20))
 
         # ボタンの表示
@@ -735,14 +2499,14 @@ class MsgBox():
             if cell[0] == "INPUT":      # INPUTはキー入力
                 pygame.draw.rect(self.screen, COLOR_WHITE, cell[1])
                 pygame.draw.rect(self.screen, COLOR_BLACK, cell[1], 1)
-                self.screen.blit(self.font.render(self.return_value,       # 入力値
-                                                  True, COLOR_BLACK),
+                self.screen.blit(render_text(self.return_value,       # 入力値
+                                             self.fontsize, COLOR_BLACK),
                                  (cell[1].left + 8, cell[1].top + 10))
 
             else:
                 pygame.draw.rect(self.screen, COLOR_SILVER, cell[1])
                 pygame.draw.rect(self.screen, COLOR_BLACK, cell[1], 1)
-                self.screen.blit(self.font.render(cell[0], True, COLOR_BLACK),  # ボタン名
+                self.screen.blit(render_text(cell[0], self.fontsize, COLOR_BLACK),  # ボタン名
                                  (cell[1].left + 8, cell[1].top + 10))
                 # マウスカーソルが項目上にある場合は、枠を描画する
                 posx, posy = pygame.mouse.get_pos()
@@ -755,11 +2519,305 @@ class MsgBox():
         # メイン画面に描画
         self.mainscreen.blit(self.screen, self.rect)
 
+class LayerScreen(SubScreen):
+    """ レイヤーの画面\n
+    左から下のレイヤー順に並べ、クリックしたレイヤーに描き込む """
+    def __init__(self, name, rect, mainscreen, sheet):
+        super().__init__(name, rect, mainscreen)
+        self.fontsize = 20
+        self.sheet = sheet              # レイヤーを持つシート
+        self.celheight = 30             # 1個のセルのサイズ
+        self.celwidth = 55
+        self.layerwidth = 70            # 1個のレイヤーのセルの幅
+        self.cells = []                 # ボタンのリスト (name, rect)
+        for i, name in enumerate(["add", "up", "down", "hide", "op-", "op+"]):
+            self.cells.append((name, Rect(5 + i * (self.celwidth + 2), 10,
+                                          self.celwidth, self.celheight)))
+        self.layerleft = 5 + len(self.cells) * (self.celwidth + 2) + 15
+                                        # レイヤーのセルを並べ始める位置
+        self.maxlayers = (rect.width - self.layerleft - 5) // (self.layerwidth + 2)
+                                        # 並べられるレイヤーの数
+        self.drawn_serial = None        # 描画したときのシートのlayer_serial
+        self.updateflg = True
+
+    def get_layer_rect(self, index):
+        """ index番目（下から）のレイヤーのセルのRect """
+        return Rect(self.layerleft + index * (self.layerwidth + 2), 10,
+                    self.layerwidth, self.celheight)
+
+    def mouse_button_down(self, pos, button):
+        """ ボタンが押されたときの処理 """
+        if button != BUTTON_LEFT:
+            return
+        sheet = self.sheet
+        layer = sheet.active
+        for name, cellrect in self.cells:
+            if cellrect.collidepoint(pos):
+                if name == "add" and len(sheet.layers) < self.maxlayers:
+                    sheet.add_layer()
+                elif name == "up":
+                    sheet.move_layer(layer, 1)
+                elif name == "down":
+                    sheet.move_layer(layer, -1)
+                elif name == "hide":
+                    sheet.set_layer_visible(layer, not layer.visible)
+                elif name == "op-":
+                    sheet.set_layer_opacity(layer, layer.opacity - 32)
+                elif name == "op+":
+                    sheet.set_layer_opacity(layer, layer.opacity + 32)
+                self.updateflg = True
+        for i, layer in enumerate(sheet.layers):
+            if self.get_layer_rect(i).collidepoint(pos):
+                sheet.select_layer(layer)
+                self.updateflg = True
+
+    def update(self):
+        """ サブスクリーンの更新\n
+        読み込みなどでレイヤーが変わったときも描き直す """
+        if self.sheet.layer_serial != self.drawn_serial:
+            self.updateflg = True
+
+    def draw(self):
+        """ レイヤー画面の描画 """
+        self.drawn_serial = self.sheet.layer_serial
+        self.screen.fill(COLOR_GRAY)
+        # ボタンの描画
+        for name, cellrect in self.cells:
+            pygame.draw.rect(self.screen, COLOR_SILVER, cellrect)
+            self.screen.blit(render_text(name, self.fontsize, COLOR_BLACK),
+                             (cellrect.left + 5, cellrect.top + 8))
+            pygame.draw.rect(self.screen, COLOR_BLACK, cellrect, 1)
+        # レイヤーの描画（選択中は白、非表示は名前を灰色にする）
+        for i, layer in enumerate(self.sheet.layers):
+            cellrect = self.get_layer_rect(i)
+            pygame.draw.rect(self.screen,
+                             COLOR_WHITE if layer is self.sheet.active else COLOR_SILVER,
+                             cellrect)
+            self.screen.blit(render_text(f"{layer.name} {layer.opacity * 100 // 255}%",
+                                         self.fontsize,
+                                         COLOR_BLACK if layer.visible else COLOR_GRAY),
+                             (cellrect.left + 5, cellrect.top + 8))
+            pygame.draw.rect(self.screen, COLOR_BLACK, cellrect, 1)
+        # レイヤー画面の枠
+        pygame.draw.rect(self.screen, COLOR_BLACK,
+                         (0, 0, self.rect.width, self.rect.height), 5)
+        self.mainscreen.blit(self.screen, self.rect)
+
+class LoadBrowser(SubScreen):
+    """ 読み込みブラウザ 保存フォルダの画像ファイルとプロジェクトファイルをサムネイルで並べる\n
+    open()で表示し、閉じるとメッセージボックスと同じUSEREVENT_MSGBOXを発行する
+    （他の画面はロックされる）\n
+    サムネイルは別スレッドで作り、ファイル名, ファイルサイズ, 更新日時をキーにして
+    キャッシュフォルダに保存する（次からはキャッシュを読むだけ）\n
+    キャッシュは並べるフォルダごとに分け、開くたびに今のファイルに無いものを消す """
+    def __init__(self, name, rect, mainscreen):
+        super().__init__(name, rect, mainscreen)
+        self.rect.center = WINDOW_RECT.center       # メイン画面中央に配置
+        self.fontsize = 20
+        self.cache_dir = os.path.dirname(__file__) + "/thumbnails/"   # サムネイルのキャッシュ
+        self.cache_subdir = self.cache_dir  # 並べているフォルダのキャッシュ
+        self.celwidth = 115             # 1個のファイルのセルのサイズ
+        self.celheight = 120
+        self.cols = (rect.width - 40) // self.celwidth                  # 横に並べる数
+        self.rows = (rect.height - 120) // self.celheight               # 縦に並べる数
+        self.entries = []               # ファイルのリスト (ファイル名, パス, サイズ, 更新日時)
+        self.scroll = 0                 # 一番上に表示している行
+        self.thumbnails = {}            # キーからサムネイルのSurfaceを引く辞書
+                                        #   作れなかったファイルはNone
+        self.requests = {}              # サムネイルを作っているキーとFutureの辞書
+        self.worker = ThreadPoolExecutor(max_workers=THUMBNAIL_WORKERS)
+                                        # サムネイルを作るスレッド
+        self.callback = None            # 閉じたときに選んだファイル名を渡して呼ぶ関数
+        self.closing = False            # 閉じるイベントを発行したか？
+                                        #   （それからはクリックとキーを無視する）
+        self.hover = None               # マウスカーソルが乗っているセル
+        self.cells = []                 # ボタンのリスト
+        self.cells.append(["UP", Rect(20, rect.height - 55, 100, 40)])
+        self.cells.append(["DOWN", Rect(130, rect.height - 55, 100, 40)])
+        self.cells.append(["INPUT", Rect(rect.width - 230, rect.height - 55, 100, 40)])
+        self.cells.append(["CANCEL", Rect(rect.width - 120, rect.height - 55, 100, 40)])
+        self.screenlevel = 1
+        self.visible = False
+
+    def open(self, directory, callback):
+        """ directoryのファイルを並べる\n
+        閉じたときにcallbackにファイル名（pngは拡張子を省く）を渡して呼ぶ
+        （ファイル名を入力するときはNone、キャンセルはFalse） """
+        self.callback = callback
+        self.closing = False
+        self.directory = directory
+        self.entries.clear()
+        self.scroll = 0
+        if os.path.isdir(directory):
+            with os.scandir(directory) as scan:
+                for entry in scan:
+                    if entry.is_file() and entry.name.endswith((".png", PROJECT_EXT)):
+                        stat = entry.stat()
+                        self.entries.append((entry.name, entry.path,
+                                             stat.st_size, stat.st_mtime_ns))
+        self.entries.sort()
+        self.cache_subdir = self.cache_dir + hashlib.sha1(
+            os.path.abspath(directory).encode("utf-8")).hexdigest()[:16] + "/"
+        self.request_thumbnails()
+        # 古いキャッシュの掃除は表示中のサムネイルの後にする
+        self.worker.submit(prune_thumbnails, self.cache_subdir,
+                           {self.get_key(entry) for entry in self.entries})
+
+    def close(self, value):
+        """ valueを戻り値にしてUSEREVENT_MSGBOXを発行する（2回目からは何もしない） """
+        if self.closing:
+            return
+        self.closing = True
+        userevent = pygame.event.Event(USEREVENT_MSGBOX,
+                                       {"msgbox_type": None, "value": value,
+                                        "callback": self.callback, "screen": self})
+        pygame.event.post(userevent)
+
+    def get_key(self, entry):
+        """ サムネイルのキー（パス, ファイルサイズ, 更新日時から作る） """
+        _, path, size, mtime = entry
+        return hashlib.sha1(f"{os.path.abspath(path)}\0{size}\0{mtime}".encode("utf-8")) \
+            .hexdigest()
+
+    def get_visible(self):
+        """ 表示中のファイルの番号のrange """
+        start = self.scroll * self.cols
+        return range(start, min(start + self.cols * self.rows, len(self.entries)))
+
+    def request_thumbnails(self):
+        """ 表示中と次のページのサムネイルを作る（表示中のほうを先に作る）\n
+        見えなくなったページのまだ始まっていないものは取り消す """
+        start = self.scroll * self.cols
+        end = min(start + self.cols * self.rows * 2, len(self.entries))
+        keys = {self.get_key(self.entries[i]): i for i in range(start, end)}
+        for key in list(self.requests):
+            if key not in keys and self.requests[key].cancel():
+                del self.requests[key]
+        for key, index in keys.items():
+            if key in self.thumbnails or key in self.requests:
+                continue
+            future = self.worker.submit(make_thumbnail, self.entries[index][1],
+                                        self.cache_subdir + key + ".png", THUMBNAIL_SIZE)
+            future.add_done_callback(lambda future, key=key: post_thumbnail_event(key, future))
+            self.requests[key] = future
+        # 表示していないサムネイルが多くなったらメモリから捨てる
+        if len(self.thumbnails) > THUMBNAIL_MEMORY:
+            for key in list(self.thumbnails):
+                if key not in keys:
+                    del self.thumbnails[key]
+
+    def thumbnail_event(self, event):
+        """ サムネイルができたときの処理 表示中のファイルのときは描き直す """
+        self.requests.pop(event.key, None)
+        self.thumbnails[event.key] = event.image
+        if self.visible:
+            self.updateflg = True
+
+    def scroll_rows(self, rows):
+        """ rows行だけ下(+)、上(-)にスクロールする """
+        maxscroll = max((len(self.entries) - 1) // self.cols - self.rows + 1, 0)
+        scroll = min(max(self.scroll + rows, 0), maxscroll)
+        if scroll != self.scroll:
+            self.scroll = scroll
+            self.request_thumbnails()
+            self.updateflg = True
+
+    def get_entry_rect(self, index):
+        """ index番目のファイルのセルの画面上のRect """
+        index -= self.scroll * self.cols
+        return Rect(20 + index % self.cols * self.celwidth,
+                    50 + index // self.cols * self.celheight,
+                    self.celwidth - 10, self.celheight - 5)
+
+    def get_cell_at(self, pos):
+        """ posにあるボタンの名前かファイルの番号（無いときはNone） """
+        for cell in self.cells:
+            if cell[1].collidepoint(pos):
+                return cell[0]
+        for i in self.get_visible():
+            if self.get_entry_rect(i).collidepoint(pos):
+                return i
+        return None
+
+    def update(self):
+        """ サブスクリーンの更新\n
+        マウスカーソルが乗っているセルが変わったときだけ描き直す """
+        posx, posy = pygame.mouse.get_pos()
+        hover = self.get_cell_at((posx - self.rect.left, posy - self.rect.top))
+        if hover != self.hover:
+            self.hover = hover
+            self.updateflg = True
+
+    def mouse_button_down(self, pos, button):
+        """ ボタンが押されたときの処理 """
+        if self.closing:
+            return
+        if button in (BUTTON_WHEELUP, BUTTON_WHEELDOWN):
+            self.scroll_rows(-1 if button == BUTTON_WHEELUP else 1)
+            return
+        if button != BUTTON_LEFT:
+            return
+        cell = self.get_cell_at(pos)
+        if cell == "UP":
+            self.scroll_rows(-self.rows)
+        elif cell == "DOWN":
+            self.scroll_rows(self.rows)
+        elif cell == "INPUT":
+            self.close(None)
+        elif cell == "CANCEL":
+            self.close(False)
+        elif cell is not None:
+            filename = self.entries[cell][0]
+            self.close(filename if filename.endswith(PROJECT_EXT)
+                       else os.path.splitext(filename)[0])
+
+    def key_down(self, key, mod):
+        """ キーが押されたときの処理 """
+        if self.closing:
+            return
+        if key == K_ESCAPE:
+            self.close(False)
+        elif key == K_PAGEUP:
+            self.scroll_rows(-self.rows)
+        elif key == K_PAGEDOWN:
+            self.scroll_rows(self.rows)
+
+    def draw(self):
+        """ 読み込みブラウザの描画 """
+        self.screen.fill(COLOR_GRAY)
+        self.screen.blit(render_text(f"load: {len(self.entries)} files", self.fontsize,
+                                     COLOR_BLACK), (20, 20))
+
+        # ファイルの表示（サムネイルができていないファイルは名前だけ）
+        for i in self.get_visible():
+            cellrect = self.get_entry_rect(i)
+            pygame.draw.rect(self.screen, COLOR_SILVER, cellrect)
+            image = self.thumbnails.get(self.get_key(self.entries[i]))
+            if image is not None:
+                center = (cellrect.centerx, cellrect.top + 5 + THUMBNAIL_SIZE // 2)
+                self.screen.blit(image, image.get_rect(center=center))
+            self.screen.blit(render_text(self.entries[i][0][:14], self.fontsize, COLOR_BLACK),
+                             (cellrect.left + 3, cellrect.bottom - 15))
+            pygame.draw.rect(self.screen, COLOR_BLACK, cellrect, 3 if i == self.hover else 1)
+
+        # ボタンの表示
+        for cell in self.cells:
+            pygame.draw.rect(self.screen, COLOR_SILVER, cell[1])
+            pygame.draw.rect(self.screen, COLOR_BLACK, cell[1], 3 if cell[0] == self.hover else 1)
+            self.screen.blit(render_text(cell[0], self.fontsize, COLOR_BLACK),  # ボタン名
+                             (cell[1].left + 8, cell[1].top + 12))
+
+        # 画面の枠
+        pygame.draw.rect(self.screen, COLOR_BLACK,
+                         (0, 0, self.rect.width, self.rect.height), 5)
+        # メイン画面に描画
+        self.mainscreen.blit(self.screen, self.rect)
+
 class MsgScreen(SubScreen):
     """ メッセージの画面（デバック用？） """
     def __init__(self, name, rect, mainscreen):
         super().__init__(name, rect, mainscreen)
-        self.font = pygame.font.SysFont(None, 30)
+        self.fontsize = 30
         self.msgs = []
 
     def draw(self):
@@ -768,10 +2826,23 @@ class MsgScreen(SubScreen):
         pygame.draw.rect(self.screen, COLOR_BLACK, (0, 0, self.rect.width, self.rect.height), 6)
         #メッセージの表示
         for i, msg in enumerate(self.msgs):
-            self.screen.blit(self.font.render(msg, True, COLOR_BLACK), (5, i * 20 + 5))
+            self.screen.blit(render_text(msg, self.fontsize, COLOR_BLACK), (5, i * 20 + 5))
 
         self.mainscreen.blit(self.screen, self.rect)
 
+@lru_cache(maxsize=None)
+def get_font(size, name=None):
+    """ フォントを取得する\n
+    SysFontはシステムのフォントを探すので時間がかかる 同じフォントは1回だけ作って使い回す """
+    return pygame.font.SysFont(name, size)
+
+@lru_cache(maxsize=512)
+def render_text(text, size, col=COLOR_BLACK, name=None):
+    """ 文字列を描いたSurfaceを取得する\n
+    同じ(フォント, サイズ, 文字列, 色)のときは前に描いたものを返すので、
+    返したSurfaceには描き込まないこと """
+    return get_font(size, name).render(text, True, col)
+
 def inistr_to_intlist(items):
     """ iniファイルのitemsリストのoptionの文字列を
     コンマで区切り、数値に変換 """
@@ -788,37 +2859,463 @@ def inistr_to_intlist(items):
 
     return retitem
 
+def bresenham_line(start, end):
+    """ startからendまでの直線上の点のリストを返す（ブレゼンハムのアルゴリズム） """
+    posx, posy = start
+    deltax = abs(end[0] - posx)
+    deltay = -abs(end[1] - posy)
+    stepx = 1 if posx < end[0] else -1
+    stepy = 1 if posy < end[1] else -1
+    error = deltax + deltay
+    points = [(posx, posy)]
+    while (posx, posy) != tuple(end):
+        error2 = error * 2
+        if error2 >= deltay:
+            error += deltay
+            posx += stepx
+        if error2 <= deltax:
+            error += deltax
+            posy += stepy
+        points.append((posx, posy))
+    return points
+
+def rect_points(start, end, fill=False):
+    """ startとendを対角にした四角形の点のリストを返す\n
+    fillがTrueのときは中も含める """
+    left, right = sorted((start[0], end[0]))
+    top, bottom = sorted((start[1], end[1]))
+    if fill or right - left < 2 or bottom - top < 2:
+        return [(posx, posy) for posy in range(top, bottom + 1)
+                for posx in range(left, right + 1)]
+    points = [(posx, posy) for posx in range(left, right + 1) for posy in (top, bottom)]
+    points += [(posx, posy) for posy in range(top + 1, bottom) for posx in (left, right)]
+    return points
+
+def ellipse_points(start, end):
+    """ startとendを対角にした四角形に内接する楕円の点のリストを返す\n
+    行ごと、列ごとの両端の点を合わせて、すき間のない輪郭にする """
+    left, right = sorted((start[0], end[0]))
+    top, bottom = sorted((start[1], end[1]))
+    centerx = (left + right) / 2
+    centery = (top + bottom) / 2
+    radiusx = (right - left + 1) / 2
+    radiusy = (bottom - top + 1) / 2
+    points = set()
+    # 行ごとの両端
+    for posy in range(top, bottom + 1):
+        half = radiusx * max(0.0, 1 - ((posy - centery) / radiusy) ** 2) ** 0.5
+        points.add((min(int(centerx), round(centerx - half + 0.5)), posy))
+        points.add((max(int(centerx + 0.5), round(centerx + half - 0.5)), posy))
+    # 列ごとの両端
+    for posx in range(left, right + 1):
+        half = radiusy * max(0.0, 1 - ((posx - centerx) / radiusx) ** 2) ** 0.5
+        points.add((posx, min(int(centery), round(centery - half + 0.5))))
+        points.add((posx, max(int(centery + 0.5), round(centery + half - 0.5))))
+    return list(points)
+
+def mask_runs(mask):
+    """ マスクの1が続く範囲 (開始, 終了+1) のリストを返す """
+    runs = []
+    start = mask.find(1)
+    while start >= 0:
+        end = mask.find(0, start)
+        if end < 0:
+            end = len(mask)
+        runs.append((start, end))
+        start = mask.find(1, end)
+    return runs
+
+def nearest_color(col, colors):
+    """ colorsの中からcolに一番近い色を返す """
+    return min(colors, key=lambda color: (color[0] - col[0]) ** 2
+                                         + (color[1] - col[1]) ** 2
+                                         + (color[2] - col[2]) ** 2)
+
+@lru_cache(maxsize=8)
+def palett_lut(colors):
+    """ 減色用の変換表を作る\n
+    RGBを5bitずつにした32768色それぞれに一番近いパレットの番号を並べる\n
+    colorsは(r, g, b)のタプル（同じパレットなら2回目からはキャッシュを返す） """
+    levels = [(value << 3) | 4 for value in range(32)]      # 5bitの値の代表の色
+    dist_b = [[(level - col[2]) ** 2 for col in colors] for level in levels]
+    lut = bytearray(32768)
+    for red in range(32):
+        dist_r = [(levels[red] - col[0]) ** 2 for col in colors]
+        for green in range(32):
+            dist_rg = [dist_r[i] + (levels[green] - col[1]) ** 2 for i, col in enumerate(colors)]
+            base = (red << 10) | (green << 5)
+            for blue in range(32):
+                dists = list(map(int.__add__, dist_rg, dist_b[blue]))
+                lut[base | blue] = dists.index(min(dists))
+    return lut
+
+def quantize(data, width, colors, dither="nearest"):
+    """ RGBのバイト列をパレットの番号のバイト列に減色する\n
+    dither: nearest（一番近い色）, ordered（4x4の組織的ディザ）,
+    floyd（Floyd-Steinbergの誤差拡散） """
+    lut = palett_lut(tuple(tuple(col) for col in colors))
+    count = len(data) // 3
+    if dither == "floyd":
+        indices = bytearray(count)
+        errors = [0] * ((width + 2) * 3)        # 今の行の誤差（16倍）
+        for posy in range(count // width):
+            next_errors = [0] * ((width + 2) * 3)   # 次の行の誤差（16倍）
+            for posx in range(width):
+                i = (posy * width + posx) * 3
+                e = posx * 3 + 3
+                red = data[i] + (errors[e] >> 4)
+                green = data[i + 1] + (errors[e + 1] >> 4)
+                blue = data[i + 2] + (errors[e + 2] >> 4)
+                red = 0 if red < 0 else 255 if red > 255 else red
+                green = 0 if green < 0 else 255 if green > 255 else green
+                blue = 0 if blue < 0 else 255 if blue > 255 else blue
+                index = lut[((red >> 3) << 10) | ((green >> 3) << 5) | (blue >> 3)]
+                indices[i // 3] = index
+                # 誤差を右、左下、下、右下に 7:3:5:1 で配る
+                col = colors[index]
+                error = red - col[0]
+                errors[e + 3] += error * 7
+                next_errors[e - 3] += error * 3
+                next_errors[e] += error * 5
+                next_errors[e + 3] += error
+                error = green - col[1]
+                errors[e + 4] += error * 7
+                next_errors[e - 2] += error * 3
+                next_errors[e + 1] += error * 5
+                next_errors[e + 4] += error
+                error = blue - col[2]
+                errors[e + 5] += error * 7
+                next_errors[e - 1] += error * 3
+                next_errors[e + 2] += error * 5
+                next_errors[e + 5] += error
+            errors = next_errors
+        return indices
+
+    # 各チャンネルを5bitにして（組織的ディザのときは位置ごとの値を足して）
+    # 変換表を引く
+    red_keys = [value << 10 for value in range(32)]
+    green_keys = [value << 5 for value in range(32)]
+    indices = bytearray(count)
+    if dither == "ordered":
+        # 4x4の位置ごとに、値を足して5bitにする変換表
+        tables = [bytes(min(255, max(0, value + offset)) >> 3 for value in range(256))
+                  for offset in DITHER_ORDERED]
+        for posy in range(count // width):
+            start = posy * width
+            for posx in range(min(4, width)):
+                table = tables[(posy % 4) * 4 + posx]
+                first = (start + posx) * 3
+                last = (start + width) * 3
+                indices[start + posx:start + width:4] = bytes(
+                    lut[red_keys[red] | green_keys[green] | blue]
+                    for red, green, blue in zip(data[first:last:12].translate(table),
+                                                data[first + 1:last:12].translate(table),
+                                                data[first + 2:last:12].translate(table)))
+        return indices
+    table = bytes(value >> 3 for value in range(256))
+    return bytearray(lut[red_keys[red] | green_keys[green] | blue]
+                     for red, green, blue in zip(data[0::3].translate(table),
+                                                 data[1::3].translate(table),
+                                                 data[2::3].translate(table)))
+
+def indices_to_rgb(indices, colors):
+    """ パレットの番号のバイト列をRGBのバイト列に変換する """
+    data = bytearray(len(indices) * 3)
+    for channel in range(3):
+        table = bytes(colors[i][channel] if i < len(colors) else 0 for i in range(256))
+        data[channel::3] = indices.translate(table)
+    return data
+
+def get_block_bytes(pixels, width, bpp, rect):
+    """ 行優先のバイト列pixels（幅width）からrectの範囲を切り出す """
+    return b"".join(pixels[((posy * width) + rect.left) * bpp:
+                           ((posy * width) + rect.right) * bpp]
+                    for posy in range(rect.top, rect.bottom))
+
+def set_block_bytes(pixels, width, bpp, rect, data):
+    """ get_block_bytes()で切り出したdataをpixelsのrectの範囲に書き戻す """
+    rowsize = rect.width * bpp
+    for i, posy in enumerate(range(rect.top, rect.bottom)):
+        start = ((posy * width) + rect.left) * bpp
+        pixels[start:start + rowsize] = data[i * rowsize:(i + 1) * rowsize]
+
+def write_project(filename, size, bpp, colors, sheets):
+    """ プロジェクトファイルを書く（別スレッドから呼んでよい）\n
+    sizeは(editcelx, editcely, blockx, blocky)\n
+    sheetsは(名前, メタデータ, 圧縮したブロックのリスト)のリスト """
+    names = [(name.encode("utf-8"), json.dumps(meta).encode("utf-8"))
+             for name, meta, _ in sheets]
+    nblocks = size[2] * size[3]
+    # 索引の後ろからチャンクを並べる
+    offset = PROJECT_HEADER.size + len(colors) * 3 + \
+        sum(PROJECT_SHEET.size + len(name) + len(meta) + nblocks * PROJECT_CHUNK.size
+            for name, meta in names)
+    index = [PROJECT_HEADER.pack(b"DOTP", PROJECT_VERSION, *size, bpp, len(colors), len(sheets)),
+             b"".join(bytes(col[:3]) for col in colors)]
+    for (name, meta), (_, _, chunks) in zip(names, sheets):
+        index.append(PROJECT_SHEET.pack(len(name), len(meta)))
+        index.append(name)
+        index.append(meta)
+        for chunk in chunks:
+            index.append(PROJECT_CHUNK.pack(offset, len(chunk)))
+            offset += len(chunk)
+    with open(filename, "wb") as file:
+        file.write(b"".join(index))
+        for _, _, chunks in sheets:
+            file.writelines(chunks)
+        file.flush()
+        os.fsync(file.fileno())
+
+def make_thumbnail(filename, cachename, size):
+    """ 読み込みブラウザのサムネイルを作る（別スレッドで実行される）\n
+    キャッシュファイルがあればそれを読み、無ければ画像ファイル（プロジェクトファイルは
+    最初のシート）をsize以内に縮小してキャッシュファイルに保存する\n
+    作れなかったときはNoneを返す """
+    if os.path.isfile(cachename):
+        try:
+            return pygame.image.load(cachename)
+        except pygame.error:
+            pass
+    try:
+        if filename.endswith(PROJECT_EXT):
+            project = ProjectFile(filename)
+            try:
+                if not project.sheets:
+                    return None
+                image = project.read_image(0)
+            finally:
+                project.close()
+        else:
+            image = pygame.image.load(filename)
+        scale = min(size / image.get_width(), size / image.get_height())
+        image = pygame.transform.scale(image, (max(int(image.get_width() * scale), 1),
+                                               max(int(image.get_height() * scale), 1)))
+        # 書きかけのキャッシュを読まないように、一時ファイルに書いてから置き換える
+        #   （一時ファイルは他のスレッドや同時に起動したエディタと重ならない名前にする）
+        cachedir = os.path.dirname(cachename)
+        os.makedirs(cachedir, exist_ok=True)
+        handle, tempname = tempfile.mkstemp(suffix=".tmp.png", dir=cachedir)
+        os.close(handle)
+        try:
+            pygame.image.save(image, tempname)
+            os.replace(tempname, cachename)
+        except (pygame.error, OSError):
+            os.remove(tempname)
+            raise
+    except (pygame.error, OSError, ValueError, zlib.error):
+        return None
+    return image
+
+def prune_thumbnails(cachedir, keys):
+    """ キャッシュフォルダからkeysに無いサムネイルを消す（別スレッドで実行される）\n
+    更新や削除されたファイルの古いキャッシュを残さないようにする
+    （書きかけの一時ファイルは古くなったものだけ消す） """
+    if not os.path.isdir(cachedir):
+        return
+    now = time.time()
+    with os.scandir(cachedir) as scan:
+        for entry in scan:
+            try:
+                if entry.name.endswith(".tmp.png"):
+                    if now - entry.stat().st_mtime > THUMBNAIL_TEMP_AGE:
+                        os.remove(entry.path)
+                elif entry.name.endswith(".png") and entry.name[:-len(".png")] not in keys:
+                    os.remove(entry.path)
+            except OSError:
+                pass                    # 他のエディタが先に消したときなど
+
+def post_thumbnail_event(key, future):
+    """ できたサムネイルをUSEREVENT_THUMBNAILで知らせる（別スレッドから呼んでよい）\n
+    取り消されたときは何もしない """
+    if future.cancelled():
+        return
+    userevent = pygame.event.Event(USEREVENT_THUMBNAIL, {"key": key, "image": future.result()})
+    pygame.event.post(userevent)
+
+def open_lock(filename):
+    """ filenameのロックファイルを開いてロックする（閉じるかプロセスが終わるまで）\n
+    他のプロセスがロックしているときはNoneを返す """
+    try:
+        file = open(filename, "wb")
+    except OSError:
+        return None
+    try:
+        if os.name == "nt":
+            msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        file.close()
+        return None
+    return file
+
+def close_lock(lock):
+    """ open_lock()で開いたロックファイルを閉じて消す """
+    lock.close()
+    try:
+        os.remove(lock.name)
+    except OSError:
+        pass
+
+def post_file_event(file_type, state, filename, **attrs):
+    """ 保存、読み込みの状況をUSEREVENT_FILEで知らせる（別スレッドから呼んでよい）\n
+    file_typeはsave, load stateはprogress（attrsにprogress）, done, error（attrsにerror） """
+    userevent = pygame.event.Event(USEREVENT_FILE, {"file_type": file_type, "state": state,
+                                                    "filename": filename, **attrs})
+    pygame.event.post(userevent)
+
+def batch_convert_file(operation, filename, output_dir, size, palett, indexed, dither):
+    """ 1ファイルの一括変換（ProcessPoolExecutorの別プロセスで実行される）\n
+    sizeは(editcelx, editcely, blockx, blocky)\n
+    エラーメッセージを返す（成功したときはNone） """
+    try:
+        sheet = SpriteSheet(*size, undomemory=0, palett=palett, indexed=indexed,
+                            quantize=dither)
+        sheet.load(filename)
+        basename = os.path.splitext(os.path.basename(filename))[0]
+        if operation == "palett":
+            # パレットの色に置き換え
+            sheet.apply_palett(palett, "nearest" if dither == "off" else dither)
+        if operation == "slice":
+            # ブロックごとに別のファイルに保存
+            for i in range(sheet.blockx * sheet.blocky):
+                pygame.image.save(sheet.surface.subsurface(sheet.get_block_rect(i)),
+                                  os.path.join(output_dir, f"{basename}_{i:03d}.png"))
+        else:
+            sheet.save(os.path.join(output_dir, basename + ".png"))
+    except (pygame.error, OSError) as err:
+        return str(err)
+    return None
+
+def batch_convert(args, palett):
+    """ 画面を出さずにフォルダ内の画像ファイルを一括変換する\n
+    convert: シートのサイズに合わせて保存し直す\n
+    palett: パレットの色に置き換える\n
+    slice: ブロックごとに別のファイルに分ける\n
+    失敗したファイルがあるときは1を返す """
+    os.environ["SDL_VIDEODRIVER"] = "dummy"           # 画面は使わない
+    filenames = sorted(glob.glob(os.path.join(args.input, "*.png")))
+    os.makedirs(args.output, exist_ok=True)
+    size = (args.editcelx, args.editcely, args.blockx, args.blocky)
+
+    errors = 0
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        results = executor.map(batch_convert_file,
+                               [args.batch] * len(filenames), filenames,
+                               [args.output] * len(filenames), [size] * len(filenames),
+                               [palett] * len(filenames),
+                               [args.mode == "indexed"] * len(filenames),
+                               [args.quantize] * len(filenames), chunksize=16)
+        for filename, error in zip(filenames, results):
+            if error is None:
+                print(f"{args.batch}: {filename}")
+            else:
+                print(f"error: {filename}: {error}", file=sys.stderr)
+                errors += 1
+    print(f"{len(filenames) - errors} / {len(filenames)} files")
+    return 1 if errors else 0
+
 def main():
     """ メイン処理 """
+    config = configparser.ConfigParser()                # 設定ファイル読み込み
+    config.read(os.path.dirname(__file__) + "/dotedit.ini", encoding="utf-8")
+
+    # シートのサイズ（コマンドライン引数 > iniファイル > 初期値の順）
+    parser = argparse.ArgumentParser(description="dotedit")
+    parser.add_argument("--editcelx", type=int,
+                        default=config.getint("document", "editcelx", fallback=32),
+                        help="1ブロックの横のドット数")
+    parser.add_argument("--editcely", type=int,
+                        default=config.getint("document", "editcely", fallback=32),
+                        help="1ブロックの縦のドット数")
+    parser.add_argument("--blockx", type=int,
+                        default=config.getint("document", "blockx", fallback=5),
+                        help="横のブロック数")
+    parser.add_argument("--blocky", type=int,
+                        default=config.getint("document", "blocky", fallback=5),
+                        help="縦のブロック数")
+    parser.add_argument("--undomemory", type=int,
+                        default=config.getint("document", "undomemory", fallback=8388608),
+                        help="元に戻す記録に使うメモリの上限（バイト）")
+    parser.add_argument("--mode", choices=["rgb", "indexed"],
+                        default=config.get("document", "mode", fallback="rgb"),
+                        help="ドットをRGBで持つか、パレットの番号で持つか")
+    parser.add_argument("--quantize", choices=["off", "nearest", "ordered", "floyd"],
+                        default=config.get("document", "quantize", fallback="off"),
+                        help="読み込んだ画像をパレットの色に減色する方法")
+    # 一括変換（画面は出さない）
+    parser.add_argument("--batch", choices=["convert", "palett", "slice"],
+                        help="フォルダ内のpngファイルを一括変換する")
+    parser.add_argument("--input", default=os.path.dirname(__file__) + "/pictures/",
+                        help="一括変換するフォルダ")
+    parser.add_argument("--output", default=os.path.dirname(__file__) + "/pictures/batch/",
+                        help="一括変換したファイルの保存先")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="一括変換のプロセス数（省略時はCPUの数）")
+    args = parser.parse_args()
+
+    palett = inistr_to_intlist(config.items("palettcolor"))
+    if args.batch:
+        sys.exit(batch_convert(args, palett))
+
     pygame.init()                                       # pygameの初期化
     pygame.mixer.quit()                                 # CPU使用率を下げるため
     screen = pygame.display.set_mode(WINDOW_RECT.size)  # メインスクリーンの生成
     screen.fill(COLOR_SILVER)
     pygame.display.set_caption("dotedit")               # タイトルバーの設定
     clock = pygame.time.Clock()                         # fps用
-    config = configparser.ConfigParser()                # 設定ファイル読み込み
-    config.read(os.path.dirname(__file__) + "/dotedit.ini", encoding="utf-8")
 
     # サブスクリーングループ
     subscreengroup = SubScreenGroup(screen, config)
     # サブスクリーンを生成しグループに追加
     subscreengroup.append(MenuBar("MenuBar", Rect(5, 5, WINDOW_RECT.width - 10, 50), screen))
-    subscreengroup.append(EditScreen("EditScreen", Rect(5, 60, 486, 486), screen))
+    sheet = SpriteSheet(args.editcelx, args.editcely, args.blockx, args.blocky,
+                        args.undomemory, palett,
+                        args.mode == "indexed", args.quantize)  # 編集するシート
+    subscreengroup.append(EditScreen("EditScreen", Rect(5, 60, 486, 486), screen, sheet))
     subscreengroup.append(PalettScreen("PalettScreen", Rect(5, 551, 486, 75), screen))
     # パレット画面の色の設定
-    palett = inistr_to_intlist(config.items("palettcolor"))
     subscreengroup.get_subscreen("PalettScreen").set_palett(palett)
-    subscreengroup.append(ViewScreen("ViewScreen", Rect(496, 60, 486, 486), screen))
+    subscreengroup.append(ViewScreen("ViewScreen", Rect(496, 60, 486, 486), screen, sheet))
+    subscreengroup.append(LayerScreen("LayerScreen",
+                                      Rect(5, 631, WINDOW_RECT.width - 10, 50), screen, sheet))
     subscreengroup.append(PalettSettingScreen("PalettSettingScreen",
                                               Rect(496, 60, 740, 520), screen))
     subscreengroup.get_subscreen("PalettSettingScreen").set_palett(palett)
     msgscreen = MsgScreen("MsgScreen", Rect(496, 551, 486, 75), screen)     # デバッグ用画面
     subscreengroup.append(msgscreen)
     msgscreen.visible = False
-
+    subscreengroup.append(LoadBrowser("LoadBrowser", Rect(0, 0, 740, 520), screen))
+    subscreengroup.append(MsgBox("MsgBox", Rect(0, 0, 300, 150), screen))
+
+    # 前回の自動保存の記録が残っていたら復元するか聞く
+    viewscreen = subscreengroup.get_subscreen("ViewScreen")
+    autosave = viewscreen.autosave
+    if autosave.find_orphan():
+        subscreengroup.open_msgbox(MSGBOX_TYPE_YESNO, ["restore autosave?"],
+                                   viewscreen.restore_autosave)
+    else:
+        viewscreen.restore_autosave(False)
+    pygame.time.set_timer(USEREVENT_AUTOSAVE, AUTOSAVE_INTERVAL)
+
+    caption = None                                      # 今のタイトル
     while True:
-        for event in pygame.event.get():
+        # 描き直す画面が無いときは、イベントが来るまで待つ（モーダル画面を表示中も同じ）
+        if subscreengroup.is_dirty():
+            events = pygame.event.get()
+        else:
+            events = [pygame.event.wait(IDLE_TIMEOUT)] + pygame.event.get()
+        for event in events:
+            if event.type == NOEVENT:                   # 待ち時間切れ
+                continue
             if event.type == QUIT:
+                # まだ始まっていないサムネイルは取り消し、作っているものと
+                # 保存中、読み込み中のファイルは終わるまで待つ（終わったらイベントを発行するので
+                # pygame.quit()より前に待つ）
+                subscreengroup.get_subscreen("LoadBrowser").worker.shutdown(wait=True,
+                                                                            cancel_futures=True)
+                subscreengroup.get_subscreen("ViewScreen").worker.shutdown(wait=True)
+                autosave.close()
                 pygame.quit()
                 sys.exit(0)
             else:
@@ -836,12 +3333,16 @@ def main():
                                   subscreengroup.get_subscreen_in_pos(pygame.mouse.get_pos()))
 
         # サブ画面の描画
-        subscreengroup.draw()
-        # タイトルにファイル名を表示
-        pygame.display.set_caption("dotedit : " \
-                                   + subscreengroup.get_subscreen("ViewScreen").save_filename)
-
-        pygame.display.update()
+        rects = subscreengroup.draw()
+        # タイトルにファイル名を表示（変わったときだけ）
+        newcaption = "dotedit : " + viewscreen.title()
+        if newcaption != caption:
+            caption = newcaption
+            pygame.display.set_caption(caption)
+
+        # 描画した部分だけ画面に反映
+        if rects:
+            pygame.display.update(rects)
         clock.tick(FPS)
 
 